@@ -0,0 +1,386 @@
+#!/usr/bin/python3
+#
+# bench  - benchmark lifescripts tools over generated trees
+#
+# usage:
+#  bench [-options] [case...]
+#  bench -C results-file [--base COMMIT] [--head COMMIT]
+#
+# Each case generates a reproducible tree under a temporary directory and
+# runs a tool's main(argv) on it, with a fresh tree for every run:
+#  --repeat timed runs, then one run counting os calls and tracing memory
+#  (kept apart since both slow the tool down). A case may check the tree
+#  after each timed run, and bench exits 1 if a check fails. Results are
+#  appended to a JSON lines file with the git commit, and -C compares two
+#  commits there.
+#
+# options:
+#  -n --files N         files in a tree
+#  -d --depth N         directory levels
+#  -w --width N         subdirectories of a directory
+#  -s --size N          largest file size
+#  --dup RATIO          files duplicating an earlier file's content
+#  --hardlink RATIO     files hard-linked to an earlier file
+#  --overlap RATIO      lower tree files also in upper tree (mergetree)
+#  --seed N
+#  -r --repeat N
+#  -o --output FILE
+#
+
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+import statistics
+import subprocess
+import collections
+import builtins
+import tracemalloc
+import importlib.util
+
+TOPDIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+
+#
+# Parse command line arguments
+#
+import argparse
+PROG = 'bench'
+DESCRIPTION = 'benchmark lifescripts tools over generated trees'
+argparser = argparse.ArgumentParser(prog=PROG, description=DESCRIPTION)
+argparser.add_argument('-n', '--files', help='files in a tree', type=int, default=2000)
+argparser.add_argument('-d', '--depth', help='directory levels', type=int, default=3)
+argparser.add_argument('-w', '--width', help='subdirectories of a directory', type=int, default=4)
+argparser.add_argument('-s', '--size', help='largest file size', type=int, default=4096)
+argparser.add_argument('--dup', help='ratio of files duplicating content', type=float, default=0.2)
+argparser.add_argument('--hardlink', help='ratio of files hard-linked', type=float, default=0.05)
+argparser.add_argument('--overlap', help='ratio of lower files also in upper tree', type=float, default=0.5)
+argparser.add_argument('--seed', help='random seed of trees', type=int, default=1)
+argparser.add_argument('-r', '--repeat', help='timed runs of a case', type=int, default=3)
+argparser.add_argument('-o', '--output', help='results file to append to', default='bench-results.jsonl')
+argparser.add_argument('-t', '--tmpdir', help='directory for generated trees')
+argparser.add_argument('-v', '--verbose', help='show output of tools', action='store_true')
+argparser.add_argument('-C', '--compare', help='compare results of two commits', metavar='RESULTS')
+argparser.add_argument('--base', help='commit compared against (default: the one before head)')
+argparser.add_argument('--head', help='commit compared (default: the last one)')
+argparser.add_argument('case', nargs='*', help='cases to run (default: all)')
+
+#
+# Tree generator
+#  files are spread over width**depth directories; content is random bytes
+#  from the seed, some duplicating an earlier file and some hard-linked to
+#  one, and mtimes are fixed, so the same spec makes the same tree
+#
+MTIME_BASE = 1600000000
+
+class Generator:
+    def __init__(self, spec):
+        self.spec = spec
+        self.rng = random.Random(spec['seed'])
+        self.dirs = ['']
+        level = ['']
+        for i in range(spec['depth']):
+            level = [os.path.join(d, 'dir%02d' % n) for d in level for n in range(spec['width'])]
+            self.dirs += level
+        self.contents = []  # [bytes]
+        self.groups = collections.defaultdict(list)   # content -> paths
+
+    def _content(self):
+        rng = self.rng
+        if self.contents and rng.random() < self.spec['dup']:
+            return rng.randrange(len(self.contents))
+        self.contents.append(rng.randbytes(rng.randrange(self.spec['size'] + 1)))
+        return len(self.contents) - 1
+
+    def write(self, root, subpath, c, mtime):
+        path = os.path.join(root, subpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(self.contents[c])
+        os.utime(path, (mtime, mtime))
+        self.groups[c].append(path)
+
+    # returns [(subpath, content, mtime)]
+    def tree(self, root, prefix='file_', count=None):
+        rng = self.rng
+        files = []
+        for d in self.dirs:
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+        for i in range(self.spec['files'] if count is None else count):
+            subpath = os.path.join(rng.choice(self.dirs), '%s%05d.dat' % (prefix, i))
+            if files and rng.random() < self.spec['hardlink']:
+                s, c, m = rng.choice(files)
+                os.link(os.path.join(root, s), os.path.join(root, subpath))
+                self.groups[c].append(os.path.join(root, subpath))
+            else:
+                c = self._content()
+                m = MTIME_BASE + rng.randrange(86400)
+                self.write(root, subpath, c, m)
+            files.append((subpath, c, m))
+        return files
+
+    # upper tree over lower files: same, newer or older, then new files
+    def upper(self, root, files):
+        rng = self.rng
+        for subpath, c, m in files:
+            if rng.random() >= self.spec['overlap']:
+                continue
+            r = rng.random()
+            if r < 1 / 3:
+                self.write(root, subpath, c, m)
+            else:
+                self.write(root, subpath, self._content(), m + (60 if r < 2 / 3 else -60))
+        self.tree(root, 'new_', int(self.spec['files'] * (1 - self.spec['overlap'])))
+
+    # fdupes output: groups of paths with the same content
+    def fdupes(self, path):
+        with open(path, 'w') as f:
+            for paths in self.groups.values():
+                if len(paths) > 1:
+                    f.write('\n'.join(paths) + '\n\n')
+
+#
+# Cases
+#  setup(tmp, spec) makes trees and returns argv of the tool
+#
+def setup_hdupes(tmp, spec):
+    Generator(spec).tree(os.path.join(tmp, 'tree'))
+    return ['-r', os.path.join(tmp, 'tree')]
+
+def setup_chkfdupes(tmp, spec):
+    g = Generator(spec)
+    g.tree(os.path.join(tmp, 'tree'))
+    g.fdupes(os.path.join(tmp, 'fdupes.out'))
+    return ['-l', os.path.join(tmp, 'fdupes.out')]
+
+def setup_mergetree(tmp, spec):
+    g = Generator(spec)
+    files = g.tree(os.path.join(tmp, 'lower'))
+    g.upper(os.path.join(tmp, 'upper'), files)
+    return ['-R', os.path.join(tmp, 'lower'), os.path.join(tmp, 'upper')]
+
+def setup_flatten(tmp, spec):
+    Generator(spec).tree(os.path.join(tmp, 'tree'))
+    return ['-l', str(spec['depth'] + 1), os.path.join(tmp, 'tree')]
+
+def setup_rerename(tmp, spec):
+    Generator(spec).tree(os.path.join(tmp, 'tree'))
+    return ['-r', '^file_', 'f-', os.path.join(tmp, 'tree')]
+
+def listing(root):
+    return sorted(os.path.relpath(os.path.join(d, n), root)
+                  for d, ds, fs in os.walk(root) for n in ds + fs)
+
+# rename files and directories with an undo log, then time the undo; a
+# level holds more renames than a batch of fsops, and the undo is checked
+def setup_rerename_undo(tmp, spec):
+    tree = os.path.join(tmp, 'tree')
+    Generator(spec).tree(tree)
+    with open(os.path.join(tmp, 'listing.json'), 'w') as f:
+        json.dump(listing(tree), f)
+    undo = os.path.join(tmp, 'undo.jsonl')
+    status = run_tool(load_tool('rerename'), ['-r', '-U', undo, '^(file_|dir)', 'x-', tree])
+    if status:
+        raise RuntimeError('rerename exited %s' % status)
+    return ['--undo', undo]
+
+def check_rerename_undo(tmp):
+    with open(os.path.join(tmp, 'listing.json')) as f:
+        if json.load(f) != listing(os.path.join(tmp, 'tree')):
+            return 'tree not restored'
+
+# name: (tool, setup(tmp, spec), check(tmp) -> error or None)
+CASES = {
+    'hdupes': ('hdupes/hdupes.py', setup_hdupes, None),
+    'chkfdupes': ('chkfdupes/chkfdupes.py', setup_chkfdupes, None),
+    'mergetree': ('mergetree/mergetree.py', setup_mergetree, None),
+    'flatten': ('flatten/flatten.py', setup_flatten, None),
+    'rerename': ('rerename/rerename.py', setup_rerename, None),
+    'rerename-undo': ('rerename/rerename.py', setup_rerename_undo, check_rerename_undo),
+}
+
+def load_tool(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(TOPDIR, CASES[name][0]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+#
+# Measurement
+#
+SYSCALLS = (
+    'stat', 'lstat', 'fstat', 'scandir', 'listdir', 'open', 'close', 'read', 'write',
+    'rename', 'replace', 'unlink', 'remove', 'rmdir', 'mkdir', 'link', 'utime', 'chmod',
+    'fsync', 'copy_file_range', 'sendfile', 'lseek',
+)
+
+# counting wrappers around os functions and open()
+class SyscallCounter:
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.saved = {}
+
+    def _wrap(self, name, f):
+        counts = self.counts
+        lock = self.lock
+        def counted(*a, **k):
+            with lock:
+                counts[name] += 1
+            return f(*a, **k)
+        return counted
+
+    def __enter__(self):
+        for name in SYSCALLS:
+            f = getattr(os, name, None)
+            if f is not None:
+                self.saved[name] = f
+                setattr(os, name, self._wrap(name, f))
+        self.saved['builtins.open'] = builtins.open
+        builtins.open = self._wrap('builtins.open', builtins.open)
+        return self
+
+    def __exit__(self, *exc):
+        builtins.open = self.saved.pop('builtins.open')
+        for name, f in self.saved.items():
+            setattr(os, name, f)
+        self.saved = {}
+
+# tool output goes to /dev/null at fd level, unless verbose
+class Quiet:
+    def __enter__(self):
+        if args.verbose: return self
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.saved = (os.dup(1), os.dup(2))
+        null = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null, 1)
+        os.dup2(null, 2)
+        os.close(null)
+        return self
+
+    def __exit__(self, *exc):
+        if args.verbose: return
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved in zip((1, 2), self.saved):
+            os.dup2(saved, fd)
+            os.close(saved)
+
+def run_tool(tool, argv):
+    with Quiet():
+        try:
+            tool.main(argv)
+        except SystemExit as e:
+            return e.code
+    return 0
+
+def run_case(name, spec):
+    tool = load_tool(name)
+    setup, check = CASES[name][1:]
+    wall = []
+    syscalls = peak = status = failed = None
+    for i in range(args.repeat + 1):
+        tmp = tempfile.mkdtemp(prefix='bench-%s-' % name, dir=args.tmpdir)
+        try:
+            argv = setup(tmp, spec)
+            if i < args.repeat:
+                t = time.perf_counter()
+                status = run_tool(tool, argv)
+                wall.append(time.perf_counter() - t)
+                if check:
+                    failed = failed or check(tmp)
+            else:
+                with SyscallCounter() as counter:
+                    tracemalloc.start()
+                    run_tool(tool, argv)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                syscalls = dict(sorted(counter.counts.items()))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return {
+        'case': name, 'spec': spec, 'status': status, 'failed': failed,
+        'wall': wall, 'median': statistics.median(wall) if wall else None,
+        'best': min(wall) if wall else None,
+        'syscalls': syscalls, 'peak': peak,
+    }
+
+def git_commit():
+    try:
+        head = subprocess.run(['git', '-C', TOPDIR, 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', '-C', TOPDIR, 'status', '--porcelain', '--untracked-files=no'],
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return head + ('+' if dirty else '')
+
+def mb(n):
+    return '%.1fMB' % (n / 1e6) if n is not None else '-'
+
+def run(cases):
+    spec = {k: getattr(args, k) for k in ('files', 'depth', 'width', 'size', 'dup', 'hardlink', 'overlap', 'seed')}
+    common = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+    }
+    ok = True
+    with open(args.output, 'a') as f:
+        for name in cases:
+            r = dict(common, **run_case(name, spec))
+            f.write(json.dumps(r, separators=(',', ':')))
+            f.write('\n')
+            f.flush()
+            print('%s: median %.3fs, best %.3fs, %d os calls, peak %s%s%s' % (
+                name, r['median'], r['best'], sum(r['syscalls'].values()), mb(r['peak']),
+                '' if r['status'] in (0, None) else ', exit %s' % r['status'],
+                ', FAILED: %s' % r['failed'] if r['failed'] else ''))
+            ok = ok and not r['failed']
+    return ok
+
+#
+# Compare results of two commits, case by case with the same spec
+#
+def compare(path):
+    results = collections.OrderedDict()  # commit -> {(case, spec): record}
+    with open(path) as f:
+        for l in f:
+            r = json.loads(l)
+            key = (r['case'], json.dumps(r['spec'], sort_keys=True))
+            results.setdefault(r['commit'], {})[key] = r
+    commits = list(results)
+    head = args.head or (commits[-1] if commits else None)
+    base = args.base or (commits[-2] if len(commits) > 1 else None)
+    if head not in results or base not in results:
+        print('%s: no results of two commits to compare' % PROG, file=sys.stderr)
+        sys.exit(1)
+    print('%s -> %s' % (base, head))
+    print('%-12s %10s %10s %7s %10s %10s %9s %9s' % (
+        'case', 'base', 'head', 'ratio', 'calls base', 'calls head', 'peak base', 'peak head'))
+    for key, h in results[head].items():
+        b = results[base].get(key)
+        if b is None:
+            continue
+        print('%-12s %9.3fs %9.3fs %6.2fx %10d %10d %9s %9s' % (
+            h['case'], b['median'], h['median'], h['median'] / max(b['median'], 1e-9),
+            sum(b['syscalls'].values()), sum(h['syscalls'].values()), mb(b['peak']), mb(h['peak'])))
+
+def main(argv=None):
+    global args
+    args = argparser.parse_args(argv)
+    if args.compare:
+        compare(args.compare)
+        return
+    for c in args.case:
+        if c not in CASES:
+            argparser.error('unknown case %s, one of %s' % (c, ', '.join(CASES)))
+    if not run(args.case or list(CASES)):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -74,13 +74,17 @@ Total saving bytes: {:,}'''.format(
     self.max_duplicates,
     self.saving_blocks * 512), file=file)
 
-stats = Stats()
+stats = None
     
 #
 # main parser
 #
 import os
 
+# shared modules, in ../common when run from the source tree
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'common'))
+import fsops
+
 class FileItem:
     def __init__(self, filename, s=None):
         if not s:
@@ -110,29 +114,15 @@ class FileItem:
         return fi
 
 #
-# file operatoin wrappeer
+# file operations, done in batches by fsops.Executor
 #
-def shell_command(cmd, *a):
-    commandline = cmd + ' ' + ' '.join(a)
-    if args.dryrun:
-        print(commandline)
-    else:
-        try:
-            if cmd == 'rm':
-                os.remove(a[0])
-            elif cmd == 'ln':
-                os.link(a[0], a[1])
-        except OSError as e:
-            print('%s: %s' % (commandline, str(e)), file=sys.stderr)
-
-
 def alter_duplicate(orig, dup):
     # remove duplicate
     if args.hardlink or args.delete:
-        shell_command('rm', dup.name)    
+        executor.add(fsops.Remove(dup.name))
     # link original
     if args.hardlink:
-        shell_command('ln', orig.name, dup.name)
+        executor.add(fsops.Link(orig.name, dup.name))
 
 def process_record(r):
     stats.add_entry()
@@ -197,24 +187,40 @@ argparser.add_argument('-d', '--delete', help='delete duplicate files', action='
 argparser.add_argument('-S', '--scanonly', help='dont stat for files, just scanning', action='store_true')
 argparser.add_argument('-N', '--dryrun', help='dont (re)move files, just reporting', action='store_true')
 argparser.add_argument('-P', '--progress', help='show progress reporting', action='store_true')
+argparser.add_argument('-j', '--jobs', help='directories altered concurrently', type=int, default=1)
+argparser.add_argument('-T', '--timing', help='report operation counts and timing', action='store_true')
 argparser.add_argument('file', nargs='+', help='fdupes outputs')
-args = argparser.parse_args()
+args = None
+executor = None
 
 
 #
-# main routine
+# main routine, importable: main(['-N', 'fdupes.out'])
 #
-for filename in args.file:
-    if filename == '-':
-        parse(sys.stdin, '(stdin)')
-    else:
-        try:    
-            with open(filename) as f:
-                parse(f, filename)
-        except OSError as e:
-            print('%s: %s' % (filename, str(e)), file=sys.stderr)
+def main(argv=None):
+    global args, stats, executor
+    args = argparser.parse_args(argv)
+    stats = Stats()
+    executor = fsops.Executor(dryrun=args.dryrun, jobs=args.jobs)
 
-#
-# final report
-#
-stats.report(file=sys.stderr)
+    for filename in args.file:
+        if filename == '-':
+            parse(sys.stdin, '(stdin)')
+        else:
+            try:    
+                with open(filename) as f:
+                    parse(f, filename)
+            except OSError as e:
+                print('%s: %s' % (filename, str(e)), file=sys.stderr)
+
+    executor.close()
+
+    #
+    # final report
+    #
+    stats.report(file=sys.stderr)
+    if args.timing:
+        executor.stats.report(file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
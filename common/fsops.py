@@ -0,0 +1,372 @@
+#
+# fsops  - bulk file operation executor shared by lifescripts tools
+#
+# Operations are queued as typed objects and done in batches:
+#
+#  ex = Executor(dryrun=args.dryrun, jobs=4)
+#  ex.add(Rename(src, dst))
+#  ex.add(Remove(path))
+#  ex.close()
+#
+# Dry-run prints, and plan writing, happen when an operation is added, so
+# their order follows the caller. Otherwise operations run when a batch is
+# full or at flush(): in order with jobs=1, or concurrently per directory
+# (the directory whose entries change) with jobs>1, keeping the order
+# within each directory. Directory fds are cached per thread and the
+# calls are made relative to them; a directory renamed or removed drops
+# the fds of its path from the caches of all threads.
+#
+# Each operation may carry a fingerprint (fp) for plans, and a check()
+# called just before it runs; a false check skips it. Errors are collected
+# in Executor.errors and per-operation counts and times in Executor.stats;
+# with stop=True, an error or a false check skips the rest of the batch in
+# that directory.
+#
+
+import sys
+import os
+import shlex
+import json
+import errno
+import time
+import threading
+import collections
+import concurrent.futures
+
+#
+# Operations
+#
+class Op:
+    __slots__ = ('path', 'target', 'fp', 'check')
+    name = None
+
+    def __init__(self, path, target=None, fp=None, check=None):
+        self.path = path
+        self.target = target
+        self.fp = fp
+        self.check = check
+
+    # directory whose entries change
+    def key(self):
+        return os.path.dirname(self.target if self.target is not None else self.path)
+
+    def args(self):
+        return (self.path,) if self.target is None else (self.path, self.target)
+
+    def command(self):
+        return ' '.join([self.name] + [shlex.quote(a) for a in self.args()])
+
+    def fingerprint(self):
+        return self.fp() if callable(self.fp) else self.fp
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.args())
+
+class Rename(Op):
+    __slots__ = ()
+    name = 'mv'
+    def do(self, fds):
+        sfd, s = fds.at(self.path)
+        dfd, d = fds.at(self.target)
+        os.rename(s, d, src_dir_fd=sfd, dst_dir_fd=dfd)
+        fds.invalidate(self.path)
+
+class Remove(Op):
+    __slots__ = ()
+    name = 'rm'
+    def do(self, fds):
+        fd, n = fds.at(self.path)
+        os.unlink(n, dir_fd=fd)
+
+class Rmdir(Op):
+    __slots__ = ()
+    name = 'rmdir'
+    def do(self, fds):
+        fd, n = fds.at(self.path)
+        os.rmdir(n, dir_fd=fd)
+        fds.invalidate(self.path)
+
+class Link(Op):
+    __slots__ = ()
+    name = 'ln'
+    def do(self, fds):
+        sfd, s = fds.at(self.path)
+        dfd, d = fds.at(self.target)
+        os.link(s, d, src_dir_fd=sfd, dst_dir_fd=dfd)
+
+class Mkdir(Op):
+    __slots__ = ('mode',)
+    name = 'mkdir'
+    def __init__(self, path, mode=0o777, fp=None, check=None):
+        super().__init__(path, fp=fp, check=check)
+        self.mode = mode
+    def args(self):
+        return (self.path, self.mode)
+    def command(self):
+        return 'mkdir -m %o %s' % (self.mode, shlex.quote(self.path))
+    def do(self, fds):
+        fd, n = fds.at(self.path)
+        os.mkdir(n, self.mode, dir_fd=fd)
+
+# mode and times of a directory, as the last of its operations
+class SetAttr(Op):
+    __slots__ = ('mode', 'atime', 'mtime')
+    name = 'setattr'
+    def __init__(self, path, mode, atime, mtime, fp=None, check=None):
+        super().__init__(path, fp=fp, check=check)
+        self.mode = mode
+        self.atime = atime  # ns
+        self.mtime = mtime
+    def args(self):
+        return (self.path, self.mode, self.atime, self.mtime)
+    def command(self):
+        p = shlex.quote(self.path)
+        return 'chmod %o %s && touch -m -d @%d.%09d %s' % (
+            self.mode, p, self.mtime // 10**9, self.mtime % 10**9, p)
+    def do(self, fds):
+        fd, n = fds.at(self.path)
+        os.chmod(n, self.mode, dir_fd=fd)
+        os.utime(n, ns=(self.atime, self.mtime), dir_fd=fd)
+
+OPERATIONS = {c.name: c for c in (Rename, Remove, Rmdir, Link, Mkdir, SetAttr)}
+
+#
+# Directory fd cache, one for each thread
+#  paths renamed or removed are appended to the executor's 'dead' list,
+#  which every cache catches up with before it is used
+#
+DIRFD_CACHE = 64
+
+class DirFds:
+    def __init__(self, executor, size=DIRFD_CACHE):
+        self.executor = executor
+        self.size = size
+        self.fds = collections.OrderedDict()
+        self.seen = 0   # entries of executor.dead applied
+
+    def catch_up(self):
+        dead = self.executor.dead
+        n = len(dead)
+        if n != self.seen:
+            for p in dead[self.seen:n]:
+                self.forget(p)
+            self.seen = n
+
+    def at(self, path):
+        self.catch_up()
+        d, n = os.path.split(path)
+        d = d or os.curdir
+        fd = self.fds.get(d)
+        if fd is None:
+            fd = os.open(d, os.O_RDONLY | os.O_DIRECTORY)
+            self.fds[d] = fd
+            if len(self.fds) > self.size:
+                os.close(self.fds.popitem(last=False)[1])
+        else:
+            self.fds.move_to_end(d)
+        return fd, n
+
+    # path renamed or removed, in all caches
+    def invalidate(self, path):
+        self.executor.dead.append(path)
+        self.forget(path)
+
+    # a directory renamed or removed, its fds are not for the path any more
+    def forget(self, path):
+        sub = path + os.sep
+        for d in [d for d in self.fds if d == path or d.startswith(sub)]:
+            os.close(self.fds.pop(d))
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
+
+#
+# Plan file
+#  JSON lines: a header object, then [op, fingerprint, path, arguments...]
+#
+class PlanWriter:
+    def __init__(self, file, header):
+        self.file = file
+        self._write(header)
+
+    def _write(self, r):
+        self.file.write(json.dumps(r, separators=(',', ':')))
+        self.file.write('\n')
+
+    def write(self, op):
+        self._write([op.name, op.fingerprint()] + list(op.args()))
+
+def read_plan(file):
+    header = json.loads(file.readline() or 'null')
+    if not isinstance(header, dict):
+        raise ValueError('not a plan file')
+    def ops():
+        for l in file:
+            name, fp, *a = json.loads(l)
+            if name not in OPERATIONS:
+                raise ValueError('unknown operation in plan: %s' % name)
+            yield OPERATIONS[name](*a, fp=fp)
+    return header, ops()
+
+#
+# Executor
+#
+class Stats:
+    def __init__(self):
+        self.count = collections.Counter()
+        self.errors = collections.Counter()
+        self.skipped = collections.Counter()
+        self.ns = collections.Counter()
+
+    def report(self, file=sys.stderr):
+        if not self.count and not self.skipped: return
+        print('Operation timing:', file=file)
+        for name in sorted(set(self.count) | set(self.skipped)):
+            n = self.count[name]
+            print(' %s: %d done, %d errors, %d skipped, %.3fs, %.1fus/op' % (
+                name, n, self.errors[name], self.skipped[name],
+                self.ns[name] / 1e9, self.ns[name] / 1e3 / n if n else 0), file=file)
+
+def print_error(op, e):
+    print('Error in %s: %s' % (op.command(), e), file=sys.stderr)
+
+BATCH = 1024
+
+class Executor:
+    # echo(str) prints dry-run commands; plan is a PlanWriter;
+    # on_exdev(op) takes over a rename across filesystems;
+    # on_done(op), on_skip(op), on_error(op, e) are called as operations end
+    def __init__(self, dryrun=False, jobs=1, batch=BATCH, plan=None, echo=print, stop=False,
+                 on_exdev=None, on_done=None, on_skip=None, on_error=print_error):
+        self.dryrun = dryrun
+        self.jobs = jobs
+        self.batch = batch
+        self.stop = stop
+        self.plan = plan
+        self.echo = echo
+        self.on_exdev = on_exdev
+        self.on_done = on_done
+        self.on_skip = on_skip
+        self.on_error = on_error
+        self.queue = []
+        self.errors = []
+        self.stats = Stats()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.caches = []
+        self.dead = []  # paths renamed or removed, for the fd caches
+        self.pool = None
+
+    def add(self, op):
+        if self.plan:
+            self.plan.write(op)
+        elif self.dryrun:
+            self.echo(op.command())
+        else:
+            self.queue.append(op)
+            if len(self.queue) >= self.batch:
+                self.flush()
+
+    def flush(self):
+        q = self.queue
+        if not q: return
+        self.queue = []
+        # nothing is running, caches catch up and the list starts over
+        for fds in self.caches:
+            fds.catch_up()
+            fds.seen = 0
+        self.dead = []
+        if self.jobs <= 1:
+            self._run(q)
+            return
+        groups = collections.OrderedDict()
+        for op in q:
+            groups.setdefault(op.key(), []).append(op)
+        if len(groups) == 1:
+            self._run(q)
+            return
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        for f in [self.pool.submit(self._run, g) for g in groups.values()]:
+            f.result()
+
+    def _fds(self):
+        fds = getattr(self.local, 'fds', None)
+        if fds is None:
+            fds = self.local.fds = DirFds(self)
+            with self.lock:
+                self.caches.append(fds)
+        return fds
+
+    # callbacks are called outside the lock, and must be thread safe
+    # themselves when jobs>1
+    def _run(self, ops):
+        fds = self._fds()
+        stats = self.stats
+        failed = set()
+        for op in ops:
+            if failed and op.key() in failed:
+                with self.lock:
+                    stats.skipped[op.name] += 1
+                continue
+            if op.check and not op.check():
+                with self.lock:
+                    stats.skipped[op.name] += 1
+                if self.stop: failed.add(op.key())
+                if self.on_skip: self.on_skip(op)
+                continue
+            t = time.perf_counter_ns()
+            e = None
+            try:
+                op.do(fds)
+            except OSError as x:
+                if x.errno == errno.EXDEV and self.on_exdev and op.name == 'mv':
+                    try:
+                        self.on_exdev(op)
+                    except OSError as y:
+                        e = y
+                else:
+                    e = x
+            t = time.perf_counter_ns() - t
+            with self.lock:
+                stats.count[op.name] += 1
+                stats.ns[op.name] += t
+                if e:
+                    stats.errors[op.name] += 1
+                    self.errors.append((op, e))
+            if e:
+                if self.stop: failed.add(op.key())
+                if self.on_error: self.on_error(op, e)
+            elif self.on_done:
+                self.on_done(op)
+
+    # an operation found failed after it was done, as an asynchronous copy
+    def error(self, op, e):
+        with self.lock:
+            self.stats.errors[op.name] += 1
+            self.errors.append((op, e))
+        if self.on_error: self.on_error(op, e)
+
+    # drop operations not started, wait for the running ones
+    def cancel(self):
+        self.queue = []
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        for fds in self.caches:
+            fds.close()
+        self.caches = []
+        self.dead = []
+        self.local = threading.local()
+
+    def close(self):
+        self.flush()
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+        for fds in self.caches:
+            fds.close()
+        self.caches = []
+        self.local = threading.local()
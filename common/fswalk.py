@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+#
+# fswalk  - directory walker shared by lifescripts tools
+#
+# usage (benchmark):
+#  fswalk [-options] path...
+#
+# Directories are listed with os.scandir() and nothing is stat'ed unless
+# asked: entry types come from the directory itself. Walking goes level by
+# level, optionally listing the directories of a level on a thread pool.
+#
+#  for d in walkdirs(top):   Dir(path, depth, entries) for each directory
+#  for e in walk(top):       Entry(dir, name, depth, kind, ino) for each entry
+#
+# options of walkdirs()/walk():
+#  maxdepth  directories deeper than this are not listed (top is 0)
+#  exclude   fnmatch patterns of names to leave out
+#  one_fs    do not descend to other filesystems
+#  jobs      directories listed concurrently
+#  prune     prune(entry) true not to descend into the directory
+#  sort      entries sorted by name
+#  onerror   onerror(OSError) for unreadable directories
+#
+
+import sys
+import os
+import re
+import fnmatch
+import concurrent.futures
+
+# entry kinds, as the directory tells
+DIR = 1
+FILE = 2
+LINK = 3
+OTHER = 4
+
+class Entry:
+    __slots__ = ('dir', 'name', 'depth', 'kind', 'ino', '_stat')
+
+    def __init__(self, dir, e, depth):
+        self.dir = dir
+        self.name = e.name
+        self.depth = depth
+        if e.is_symlink():
+            self.kind = LINK
+        elif e.is_dir(follow_symlinks=False):
+            self.kind = DIR
+        elif e.is_file(follow_symlinks=False):
+            self.kind = FILE
+        else:
+            self.kind = OTHER
+        self.ino = e.inode()
+        self._stat = None
+
+    @property
+    def path(self):
+        return os.path.join(self.dir, self.name)
+
+    def is_dir(self): return self.kind == DIR
+    def is_file(self): return self.kind == FILE
+    def is_symlink(self): return self.kind == LINK
+
+    # lstat, once
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.lstat(self.path)
+        return self._stat
+
+    def __repr__(self):
+        return 'Entry(%r)' % self.path
+
+class Dir:
+    __slots__ = ('path', 'depth', 'entries')
+
+    def __init__(self, path, depth, entries):
+        self.path = path
+        self.depth = depth
+        self.entries = entries
+
+    def __len__(self): return len(self.entries)
+    def __iter__(self): return iter(self.entries)
+
+def _matcher(exclude):
+    if not exclude:
+        return None
+    return re.compile('|'.join(fnmatch.translate(p) for p in exclude)).match
+
+def listdir(path, depth=0, exclude=None, sort=False):
+    entries = []
+    with os.scandir(path) as it:
+        for e in it:
+            if exclude and exclude(e.name):
+                continue
+            entries.append(Entry(path, e, depth + 1))
+    if sort:
+        entries.sort(key=lambda e: e.name)
+    return Dir(path, depth, entries)
+
+LEVEL_CHUNK = 1024  # directories listed in a go when parallel
+
+def walkdirs(top, maxdepth=None, exclude=None, one_fs=False, jobs=1, prune=None, sort=False, onerror=None):
+    match = _matcher(exclude)
+    dev = os.stat(top).st_dev if one_fs else None
+
+    def list1(a):
+        try:
+            return listdir(a[0], a[1], match, sort)
+        except OSError as e:
+            if onerror: onerror(e)
+            return None
+
+    pool = concurrent.futures.ThreadPoolExecutor(jobs) if jobs > 1 else None
+    try:
+        level = [(top, 0)]
+        while level:
+            nextlevel = []
+            for i in range(0, len(level), LEVEL_CHUNK):
+                chunk = level[i:i + LEVEL_CHUNK]
+                for d in (pool.map(list1, chunk) if pool else map(list1, chunk)):
+                    if d is None:
+                        continue
+                    yield d
+                    if maxdepth is not None and d.depth >= maxdepth:
+                        continue
+                    for e in d.entries:
+                        if e.kind != DIR:
+                            continue
+                        if dev is not None and e.stat().st_dev != dev:
+                            continue
+                        if prune and prune(e):
+                            continue
+                        nextlevel.append((e.path, e.depth))
+            level = nextlevel
+    finally:
+        if pool:
+            pool.shutdown()
+
+def walk(top, **kw):
+    for d in walkdirs(top, **kw):
+        yield from d.entries
+
+#
+# Benchmark main
+#
+if __name__ == '__main__':
+    import time
+    import argparse
+    argparser = argparse.ArgumentParser(prog='fswalk', description='walk directory trees and report the speed')
+    argparser.add_argument('-j', '--jobs', help='directories listed concurrently', type=int, default=1)
+    argparser.add_argument('-d', '--maxdepth', help='deepest directory level listed', type=int)
+    argparser.add_argument('-E', '--exclude', help='name pattern to leave out', action='append')
+    argparser.add_argument('-x', '--one-file-system', help='stay on one filesystem', action='store_true')
+    argparser.add_argument('-s', '--stat', help='lstat every entry', action='store_true')
+    argparser.add_argument('path', nargs='+', help='tree to walk')
+    args = argparser.parse_args()
+
+    for p in args.path:
+        t = time.perf_counter()
+        ndirs = nentries = 0
+        for d in walkdirs(p, maxdepth=args.maxdepth, exclude=args.exclude,
+                          one_fs=args.one_file_system, jobs=args.jobs,
+                          onerror=lambda e: print(e, file=sys.stderr)):
+            ndirs += 1
+            nentries += len(d.entries)
+            if args.stat:
+                for e in d.entries: e.stat()
+        t = time.perf_counter() - t
+        print('%s: %d directories, %d entries, %.3fs, %.0f entries/s' % (
+            p, ndirs, nentries, t, nentries / max(t, 1e-9)))
@@ -0,0 +1,18 @@
+#!/bin/sh
+# shared modules, installed next to the tools importing them;
+# run by the install.sh of those tools (a TEMPINSTALL of a tool runs it
+# from the checkout, where ../common is found without installing)
+MODULES="fswalk.py fsops.py"
+DEST=$HOME/bin
+
+# flags
+#TEMPINSTALL=yes
+
+for SRC in $MODULES; do
+	if [ "$TEMPINSTALL" = 'yes' ]; then
+		rm -f $DEST/$SRC
+		ln -s "`pwd`/$SRC" $DEST/$SRC
+	else
+		/usr/bin/install -m 644 $SRC $DEST/$SRC
+	fi
+done
@@ -3,14 +3,24 @@
 # flatten
 #
 # usage: flatten [options] path...
+#        flatten [options] -u mapping-file
 #
 # options:
 #  -l --level N
 #  -s --separator STR
+#  -m --mapping FILE
+#  -S --summary
 #
 
 import sys
 import os
+import json
+import threading
+
+# shared modules, in ../common when run from the source tree
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'common'))
+import fswalk
+import fsops
 
 #
 # Parse command line arguments
@@ -23,35 +33,208 @@ argparser.add_argument('-l', '--level', help='flatten level', type=int, default=
 argparser.add_argument('-s', '--separator', help='path seperator string', default='-')
 argparser.add_argument('-w', '--remove-whitespaces', help='remove white space characters from pathname', action='store_true')
 argparser.add_argument('-N', '--dryrun', help='do nothing, just scanning', action='store_true')
-argparser.add_argument('path', nargs='+', help='path to flatten')
+argparser.add_argument('-j', '--jobs', help='directories listed and moved to concurrently', type=int, default=1)
+argparser.add_argument('-S', '--summary', help='report operation counts and timing', action='store_true')
+argparser.add_argument('-m', '--mapping', help='write mapping of moves to file, for --unflatten')
+argparser.add_argument('-u', '--unflatten', help='move files back as recorded in mapping file', metavar='MAPPING')
+argparser.add_argument('path', nargs='*', help='path to flatten')
+args = None
+
+WHITE_SPACES = [' ', '\t', '\n', '\r']
+whitespace_pattern = None
+
+errors = []
+
+def error(*a):
+    errors.append(' '.join(a))
+
+#
+# Flatten plan
+#  files of a directory go up to its parent as dirname+separator+file;
+#  planned per directory with the names scandir() gives, and targets are
+#  looked up in an index of names taken in each target directory, a taken
+#  name gets the first free suffix: name~1.ext, name~2.ext, ...
+#
+class Batch:
+    __slots__ = ('src', 'dst', 'renames')
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.renames = []   # [(name, newname)]
+
+class NameIndex:
+    def __init__(self):
+        self.names = {}  # directory path -> set of names taken
 
-args = argparser.parse_args()
+    def set(self, d, names):
+        self.names[d] = set(names)
 
-# some preparation
-if args.remove_whitespaces:
-    WHITE_SPACES = [' ', '\t', '\n', '\r']
-    m = {}
-    for c in WHITE_SPACES:
-        m[c] = None
-    whitespace_pattern = str.maketrans(m)
+    # returns name or suffixed one, now taken
+    def take(self, d, name):
+        taken = self.names.get(d)
+        if taken is None:
+            taken = self.names[d] = set(os.listdir(d))
+        if name in taken:
+            stem, ext = os.path.splitext(name)
+            n = 1
+            while '%s~%d%s' % (stem, n, ext) in taken:
+                n += 1
+            name = '%s~%d%s' % (stem, n, ext)
+        taken.add(name)
+        return name
 
-# process one file
-def do_process(src, dst):
+index = None
+batches = []
+
+def new_name(d, name):
+    n = os.path.basename(d)
+    if n in ('', os.curdir, os.pardir):
+        n = os.path.basename(os.path.abspath(d))
+    n = n + args.separator + name
     if args.remove_whitespaces:
-        dst = dst.translate(whitespace_pattern)    
-    if args.dryrun:
-        print('mv %s %s'%(src,dst))
+        n = n.translate(whitespace_pattern)
+    return n
+
+def plan_directory(d, files):
+    if os.path.basename(d) in (os.curdir, os.pardir):
+        parent = os.path.join(d, os.pardir)
     else:
-        os.rename(src, dst)
+        parent = os.path.dirname(d) or os.curdir
+    b = Batch(d, parent)
+    for name in files:
+        b.renames.append((name, index.take(parent, new_name(d, name))))
+    if b.renames:
+        batches.append(b)
 
 #
 # Traverse directory tree
+#  the top is level 1; directories below the level are never listed
+#
+def scan_tree(top):
+    for d in fswalk.walkdirs(top, maxdepth=args.level - 1, jobs=args.jobs,
+                             onerror=lambda e: error(str(e))):
+        index.set(d.path, [e.name for e in d])
+        # symbolic links to directories stay, as directories do
+        files = [e.name for e in d if not e.is_dir() and not (e.is_symlink() and os.path.isdir(e.path))]
+        files.sort()
+        plan_directory(d.path, files)
+
 #
-for p in args.path:
-    for path, dirs, files in os.walk(p):
-        if len(path.split(sep=os.sep)) > args.level:
-            continue
-        for file in files:
-            src = os.path.join(path, file)
-            dst = path + args.separator + file
-            do_process(src, dst)
+# Mapping file
+#  JSON lines: {"from": srcdir, "to": dstdir} starts a batch, then
+#  [name, newname] for each move done; directories are absolute paths, so
+#  unflatten streams it back from anywhere
+#
+class Mapping:
+    def __init__(self, path):
+        self.file = open(path, 'w')
+        self.cwd = os.getcwd()
+        self.dirs = None
+        self.lock = threading.Lock()   # moves end in executor threads
+
+    def _write(self, r):
+        self.file.write(json.dumps(r, separators=(',', ':')))
+        self.file.write('\n')
+
+    # on_done of the executor, a move done
+    def write(self, op):
+        src, name = os.path.split(op.path)
+        dst, newname = os.path.split(op.target)
+        src = os.path.normpath(os.path.join(self.cwd, src))
+        dst = os.path.normpath(os.path.join(self.cwd, dst))
+        with self.lock:
+            if self.dirs != (src, dst):
+                self._write({'from': src, 'to': dst})
+                self.dirs = (src, dst)
+            self._write([name, newname])
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+def read_mapping(path):
+    with open(path) as f:
+        b = None
+        for l in f:
+            r = json.loads(l)
+            if isinstance(r, dict):    # a batch, moving back
+                b = Batch(r['to'], r['from'])
+                yield b, None
+            else:
+                yield b, r
+
+# moves of a batch, done by fsops.Executor
+def process(executor, b):
+    for src, dst in b.renames:
+        executor.add(fsops.Rename(os.path.join(b.src, src), os.path.join(b.dst, dst)))
+
+def finish(executor):
+    executor.close()
+    if args.summary:
+        executor.stats.report()
+
+def flatten(paths):
+    for p in paths:
+        scan_tree(os.path.normpath(p))
+    if errors:
+        for e in errors:
+            print(e, file=sys.stderr)
+        print('%s: nothing moved' % PROG_NAME, file=sys.stderr)
+        sys.exit(1)
+
+    mapping = Mapping(args.mapping) if args.mapping and not args.dryrun else None
+    executor = fsops.Executor(dryrun=args.dryrun, jobs=args.jobs,
+                              on_done=mapping.write if mapping else None)
+    for b in sorted(batches, key=lambda b: b.dst):
+        process(executor, b)
+    finish(executor)
+    if mapping:
+        mapping.close()
+
+def report_skip(op):
+    print('Skipped %s: target exists' % op.command(), file=sys.stderr)
+
+# moving back never overwrites, the name may be taken again since
+def target_free(op):
+    return not os.path.lexists(op.target)
+
+# one streaming pass, moves queued back as they are read
+def unflatten(path):
+    executor = fsops.Executor(dryrun=args.dryrun, jobs=args.jobs, on_skip=report_skip)
+    for b, r in read_mapping(path):
+        if r is not None:
+            op = fsops.Rename(os.path.join(b.src, r[1]), os.path.join(b.dst, r[0]))
+            op.check = lambda op=op: target_free(op)
+            executor.add(op)
+    finish(executor)
+    if executor.errors or executor.stats.skipped:
+        sys.exit(1)
+
+#
+# main, importable: main(['-l', '2', path])
+#
+def main(argv=None):
+    global args, whitespace_pattern, errors, index, batches
+    args = argparser.parse_args(argv)
+    if not args.unflatten and not args.path:
+        argparser.error('path is required')
+
+    # some preparation
+    if args.remove_whitespaces:
+        m = {}
+        for c in WHITE_SPACES:
+            m[c] = None
+        whitespace_pattern = str.maketrans(m)
+    errors = []
+    index = NameIndex()
+    batches = []
+
+    if args.unflatten:
+        unflatten(args.unflatten)
+    else:
+        flatten(args.path)
+
+if __name__ == '__main__':
+    main()
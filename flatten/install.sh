@@ -4,4 +4,7 @@ DEST=$HOME/bin
 PROG=flatten
 SRC=flatten.py
 
+# shared modules it imports, from ../common
+(cd ../common && sh ./install.sh)
+
 /usr/bin/install $SRC $DEST/$PROG
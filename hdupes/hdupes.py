@@ -8,6 +8,10 @@ import os
 from stat import *
 import hashlib
 
+# shared modules, in ../common when run from the source tree
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'common'))
+import fswalk
+
 #
 # program constants
 #
@@ -71,12 +75,15 @@ class FileStore:
             return  # already linked, skip it
  
     def scan_directory(self, path):
-        for base, dirs, files in os.walk(path):
-            for file in files:
-                self.add_file(os.path.join(base, file))
-
+        # only regular files are stat'ed
+        for e in fswalk.walk(path, exclude=args.exclude, one_fs=args.one_file_system,
+                             jobs=args.jobs, onerror=lambda e: error(str(e))):
+            if e.is_file():
+                try:
+                    self.add_file(e.path, e.stat())
+                except OSError as x:
+                    error(str(x))
 
-filestore = FileStore()            
 
 #
 # pretty printers
@@ -96,8 +103,11 @@ argparser = argparse.ArgumentParser(prog=PROG, description=DESCRIPTION)
 argparser.add_argument('-r', '--recurse', help='for every directory given follow subdirectories encounterd within', action='store_true')
 argparser.add_argument('-N', '--dryrun', help='dont (re)move files, just reporting', action='store_true')
 argparser.add_argument('-P', '--progress', help='show progress reporting', action='store_true')
+argparser.add_argument('-x', '--one-file-system', help='do not descend to other filesystems', action='store_true')
+argparser.add_argument('-E', '--exclude', help='leave out names matching pattern', action='append')
+argparser.add_argument('-j', '--jobs', help='directories listed concurrently', type=int, default=1)
 argparser.add_argument('files', nargs='+', help='fdupes outputs')
-args = argparser.parse_args()
+args = None
 
 #
 # File Digest calculator
@@ -178,57 +188,68 @@ def process_file(path, stat=None):
     pass
 
 #
-# Phase 1:
-#  make 'filestore' with scanning all directory
-#  generated: pure list of files which has no hard-linked duplicates
-#
-for path in args.files:
-    try:
-        if not os.path.exists(path):
-            error(path, 'not found')
-            continue
-        s = os.lstat(path)
-    except OSError as e:
-        error(str(e))
-
-    m = s.st_mode
-    if S_ISDIR(m):
-        if args.recurse:
-            filestore.scan_directory(path)
+# main, importable: main(['-r', path])
+#
+def main(argv=None):
+    global args
+    args = argparser.parse_args(argv)
+    filestore = FileStore()
+
+    #
+    # Phase 1:
+    #  make 'filestore' with scanning all directory
+    #  generated: pure list of files which has no hard-linked duplicates
+    #
+    for path in args.files:
+        try:
+            if not os.path.exists(path):
+                error(path, 'not found')
+                continue
+            s = os.lstat(path)
+        except OSError as e:
+            error(str(e))
+
+        m = s.st_mode
+        if S_ISDIR(m):
+            if args.recurse:
+                filestore.scan_directory(path)
+            else:
+                error(path, 'is directory, skipping')
+        elif S_ISREG(path):
+            filestore.add(path, s)
         else:
-            error(path, 'is directory, skipping')
-    elif S_ISREG(path):
-        filestore.add(path, s)
-    else:
-        error(path, 'is not a reguler file, skipping')
+            error(path, 'is not a reguler file, skipping')
 
-files = filestore.nodes()
-#xxx#del filestore
+    files = filestore.nodes()
+    #xxx#del filestore
 
-#
-# Phase 2: for each digest level
-#  2.1: calculate digest for each file
-#  2.2: eliminate entries which has same digest
-#
-hashlevel = 0
-hashtable = HashTable(hashlevel)
+    #
+    # Phase 2: for each digest level
+    #  2.1: calculate digest for each file
+    #  2.2: eliminate entries which has same digest
+    #
+    hashlevel = 0
+    hashtable = HashTable(hashlevel)
 
-digester = FileDigest()
+    digester = FileDigest()
 
-for fn in files:
-    try:
-        v = digester.calc(fn.path(), hashlevel)
-        hashtable.append(v, fn)
-    except OSError as e:
-        error(str(e))
+    for fn in files:
+        try:
+            v = digester.calc(fn.path(), hashlevel)
+            hashtable.append(v, fn)
+        except OSError as e:
+            error(str(e))
 
-dupes = hashtable.dupes()
-# for d in dupes:
-#     print([fn.path() for fn in d])
-hashlevel += 1
-for files in dupes:
-    hashtable = HashTable(hashlevel)
+    dupes = hashtable.dupes()
+    # for d in dupes:
+    #     print([fn.path() for fn in d])
+    hashlevel += 1
+    for files in dupes:
+        hashtable = HashTable(hashlevel)
 
-# XXX
-# debug dump
-#
+    # XXX
+    # debug dump
+    #
+
+if __name__ == '__main__':
+    main()
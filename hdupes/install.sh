@@ -19,4 +19,7 @@ EOF
 	exit 0
 fi
 
+# shared modules it imports, from ../common
+(cd ../common && sh ./install.sh)
+
 /usr/bin/install $SRC $DEST/$PROG
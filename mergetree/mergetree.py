@@ -4,6 +4,9 @@
 #
 # usage:
 #  mergetree [-options] lower-tree upper-tree
+#  mergetree [-options] -p plan-file lower-tree upper-tree
+#  mergetree [-options] -A plan-file
+#  mergetree [-options] -J journal-file lower-tree upper-tree
 #
 # options:
 #
@@ -13,6 +16,21 @@ DESCRIPTION='merge two directory trees into one'
 import sys
 import os
 import stat
+import json
+import itertools
+import errno
+import time
+import threading
+import concurrent.futures
+import queue
+import hashlib
+import filecmp
+import shutil
+
+# shared modules, in ../common when run from the source tree
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'common'))
+import fswalk
+import fsops
 
 #
 # Parse command line arguments
@@ -25,52 +43,142 @@ argparser.add_argument('-s', '--strict', help='compare with strict matching', ac
 argparser.add_argument('-B', '--backup', help='backup filename suffix', default='###')
 argparser.add_argument('-v', '--verbose', help='verbosly reporting', action='store_true')
 argparser.add_argument('-P', '--progress', help='progress reporting', action='store_true')
+argparser.add_argument('-L', '--log', help='write verbose report to file (implies -v)')
 argparser.add_argument('-S', '--summary', help='reports summary', action='store_true')
-argparser.add_argument('lower', help='lower tree (remains)')
-argparser.add_argument('upper', help='upper tree (removed)')
+argparser.add_argument('-p', '--plan', help='write operation plan to file instead of doing it')
+argparser.add_argument('-A', '--apply', help='apply operation plan made by --plan', metavar='PLAN')
+argparser.add_argument('--batch', help='number of operations applied in a batch', type=int, default=1024)
+argparser.add_argument('-j', '--jobs', help='parallel listing and cross-device copies', type=int, default=4)
+argparser.add_argument('--inflight', help='MiB being copied at once for cross-device moves', type=int, default=256)
+argparser.add_argument('-D', '--dedupe', help='hard-link or drop upper-only files whose content is already in lower tree', choices=['link', 'drop'])
+argparser.add_argument('--index', help='content index file of lower tree, reused and updated by --dedupe')
+argparser.add_argument('-J', '--journal', help='journal file to resume an interrupted merge or apply')
+argparser.add_argument('lower', nargs='?', help='lower tree (remains)')
+argparser.add_argument('upper', nargs='?', help='upper tree (removed)')
 
-args = argparser.parse_args()
-#XXX#
-#args.dryrun = True
-#args.verbose = True
+args = None
 
 #
 # Pretyprinter
+#  verbose lines are queued as tuples and joined/written by a writer thread;
+#  dryrun commands go the same way when both are on stdout, to keep order
 #
+LOG_QUEUE = 4096
+
+class LogWriter:
+    def __init__(self, file):
+        self.file = file
+        self.queue = queue.Queue(LOG_QUEUE)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, a):
+        self.queue.put(a)
+
+    def _run(self):
+        q = self.queue
+        while True:
+            a = q.get()
+            lines = []
+            while a is not None:
+                lines.append(' '.join(a))
+                if q.empty() or len(lines) >= LOG_QUEUE: break
+                a = q.get()
+            if lines:
+                lines.append('')
+                self.file.write('\n'.join(lines))
+            if a is None: break
+        self.file.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.file is not sys.stdout:
+            self.file.close()
+
+log = None
+
 def verbose(*a):
-    if args.verbose:    
-        print(' '.join(a))
+    if log:
+        log.put(a)
+
+def echo(*a):
+    if log and log.file is sys.stdout:
+        log.put(a)
+    else:
+        print(*a)
+
+#
+# Progress reporter
+#  the hot loops only bump counters; a timer thread prints them at a fixed
+#  rate with files/s, bytes/s and, when the phase total is known, an ETA
+#
+PROGRESS_INTERVAL = 0.5
 
-def internal_error(*a):
-    print(' '.join(a), file=sys.stderr)
+def hms(t):
+    t = int(t)
+    return '%d:%02d:%02d' % (t // 3600, t // 60 % 60, t % 60)
 
 class ProgressReporter:
     def __init__(self, active=True):
-        self.count = 0
-        self.mask = 0
-        self.heading = None
         self.active = active
-
-    def start(self, heading):
-        if not self.active: return    
+        self.heading = None
+        self.total = None
         self.count = 0
-        self.mask = 0
-        self.heading = heading
-        print(self.heading, end='\r', file=sys.stderr)
+        self.bytes = 0
+        self.started = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop = threading.Event()
 
-    def increment(self):
+    def start(self, heading, total=None):
         if not self.active: return
-        self.count += 1
-        if (self.count & self.mask) == 0:
-            print(self.heading, self.count, end='\r', file=sys.stderr)
-        if self.count >= self.mask and self.mask < 1024:
-            self.mask = (self.mask << 1) | 1
+        with self.lock:
+            self.heading = heading
+            self.total = total
+            self.count = 0
+            self.bytes = 0
+            self.started = time.monotonic()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def increment(self, n=1):
+        self.count += n
+
+    # may be called from copier threads
+    def transfer(self, n):
+        with self.lock:
+            self.bytes += n
 
     def fin(self):
         if not self.active: return
-        print(self.heading, self.count, file=sys.stderr)
+        with self.lock:
+            self._show('\n')
+            self.heading = None
+
+    def close(self):
+        if self.thread is None: return
+        self.stop.set()
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        while not self.stop.wait(PROGRESS_INTERVAL):
+            with self.lock:
+                if self.heading is not None:
+                    self._show('\r')
 
-progress = ProgressReporter(args.progress)
+    def _show(self, end):
+        t = max(time.monotonic() - self.started, 1e-3)
+        line = [self.heading, str(self.count), '%.0f/s' % (self.count / t)]
+        if self.bytes:
+            line.append('%.1fMB/s' % (self.bytes / t / 1e6))
+        if self.total and self.count and end == '\r':
+            line.append('ETA ' + hms(t * (self.total - self.count) / self.count))
+        print(' '.join(line), end=end, file=sys.stderr)
+
+progress = None
 
 class Summary:
     def __init__(self):
@@ -87,6 +195,14 @@ class Summary:
         self.moved = 0    
         self.removed = 0
         self.dirremoved = 0
+        self.stale = 0
+        self.resumed = 0
+        self.copied = 0
+        self.copiedbytes = 0
+        self.copyfailed = 0
+        self.duplicates = 0
+        self.linked = 0
+        self.dirmade = 0
 
     def only_in_lower(self, f):
         verbose('>>>', f.subpath())
@@ -128,16 +244,40 @@ class Summary:
         verbose('!!!', f.subpath())
         self.backupd += 1
 
+    def duplicate(self, f):
+        verbose('=#=', f.subpath())
+        self.duplicates += 1
+
+    def merged_before(self, f):
+        verbose('/=/', f.subpath())
+        self.resumed += 1
+
+    def changed(self, path):
+        verbose('?!?', path)
+        self.stale += 1
+
     def move(self): self.moved += 1
     def remove(self): self.removed += 1
     def removedir(self): self.dirremoved += 1
+    def link(self): self.linked += 1
+    def makedir(self): self.dirmade += 1
 
     def report(self, file=sys.stderr):
         print('', file=file)
         print('Processing Summary:', file=file)
         print(' Moved:', self.moved, file=file)
+        if self.copied:
+            print(' Copied across devices:', self.copied, 'files,', self.copiedbytes, 'bytes', file=file)
+        if self.copyfailed:
+            print(' Failed moves across devices:', self.copyfailed, file=file)
         print(' Removed files:', self.removed, file=file)
         print(' Removed directories:', self.dirremoved, file=file)
+        if self.linked or self.dirmade:
+            print(' Hard-linked files:', self.linked, file=file)
+            print(' Made directories:', self.dirmade, file=file)
+        if args.apply:
+            print(' Skipped (changed since planned):', self.stale, file=file)
+            return
         print('', file=file)
         print(' Identical files:', self.identical, file=file)
         print(' Overridden files:', self.overrided, file=file)
@@ -148,8 +288,27 @@ class Summary:
         print(' Older files:', self.olderfiles, file=file)
         print(' Newer files:', self.newerfiles, file=file)
         print(' Seems same content:', self.samefiles, file=file)
+        if self.resumed:
+            print(' Directories merged before:', self.resumed, file=file)
+        if args.dedupe:
+            print(' Content already in lower-tree:', self.duplicates, file=file)
 
-summary = Summary()        
+summary = None
+
+#
+# Stat fingerprint: the part of lstat() a planned decision depends on
+#  directory mtime changes while merging into it, so only dev/ino for dirs
+#
+def fingerprint(s):
+    if stat.S_ISDIR(s.st_mode):
+        return [s.st_dev, s.st_ino]
+    return [s.st_dev, s.st_ino, s.st_size, s.st_mtime_ns]
+
+def fingerprint_matches(path, fp):
+    try:
+        return fingerprint(os.lstat(path)) == fp
+    except OSError:
+        return False
 
 #
 # Elemental class: FileItem
@@ -166,13 +325,22 @@ class FileItem:
         if not base: base = self.base
         return base + self.subpath()
 
-    def __init__(self, base, dir, name):
+    # entry: fswalk.Entry; the type comes from the directory listing
+    #  and lstat is done only when some decision needs it
+    def __init__(self, base, dir, name, entry=None):
         self.base = base
         self.dir = dir
         self.name = name
-        self.stat = os.lstat(self.path())
+        self.entry = entry
+        self._stat = None
         self.subtree = None
 
+    @property
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.lstat(self.path())
+        return self._stat
+
     def __str__(self):
         return self.path()
 
@@ -180,8 +348,10 @@ class FileItem:
         self.subtree = tree
 
     def is_dir(self):
+        if self.entry: return self.entry.kind == fswalk.DIR
         return stat.S_ISDIR(self.stat.st_mode)
     def is_reg(self):
+        if self.entry: return self.entry.kind == fswalk.FILE
         return stat.S_ISREG(self.stat.st_mode)
 
     def dev(self):
@@ -196,24 +366,53 @@ class FileItem:
     def is_sameinode(self, o):
         return self.dev() == o.dev() and self.ino() == o.ino()
 
+    def fingerprint(self):
+        return fingerprint(self.stat)
+
+    # number of entries it stands for
+    def weight(self):
+        return 1 + self.subtree.total if self.subtree else 1
+
 #
 # Elemental class: DirectoryTree
 #
+def raise_error(e):
+    raise e
+
 class Tree:
-    def _traverse(self, d):
-        l = os.listdir(self.base + d)
-        l.sort()
-        for e in l:
-            progress.increment()                
-            f = FileItem(self.base, d, e)
-            self.entries.append(f)
-            if f.is_dir(): # dig into subdirectory
-                f.add_subtree(Tree(self.base, d + os.sep + e))
-
-    def __init__(self, base, subdir=''):
+    # whole tree is listed level by level, subtrees filled as reached
+    def _traverse(self):
+        trees = {self.base: self}   # listed next, by path
+        for d in fswalk.walkdirs(self.base, sort=True, jobs=args.jobs,
+                                 prune=lambda e: e.path not in trees, onerror=raise_error):
+            t = trees.pop(d.path)
+            for e in d.entries:
+                progress.increment()                
+                f = FileItem(self.base, t.subdir, e.name, e)
+                t.entries.append(f)
+                if f.is_dir() and self.prune_done and journal and f.subpath() in journal.done:
+                    continue    # merged by previous run, leave it unlisted
+                if f.is_dir(): # dig into subdirectory
+                    f.add_subtree(Tree(self.base, f.subpath()))
+                    trees[e.path] = f.subtree
+        self._count()
+
+    def _count(self):
+        self.total = len(self.entries)
+        for f in self.entries:
+            if f.subtree:
+                self.total += f.subtree._count()
+        return self.total
+
+    # prune_done: leave directories the journal has as merged unlisted
+    def __init__(self, base, subdir='', prune_done=True):
         self.base = base
+        self.subdir = subdir
+        self.prune_done = prune_done
         self.entries = []
-        self._traverse(subdir)
+        self.total = 0  # entries in whole subtree
+        if subdir == '':
+            self._traverse()
 
     def _dump(self, indent=0, file=sys.stdout):
         for f in self.entries:
@@ -232,46 +431,497 @@ class Tree:
     def __getitem__(self, i): return self.entries[i]
 
 #
-# Action wrapper
+# Cross-device copy engine
+#  os.rename() fails with EXDEV between filesystems, then the source is
+#  copied in the kernel (copy_file_range, sendfile, read/write in that order),
+#  keeping mode and mtime. Files are copied by a thread pool limited by
+#  bytes in flight; directories are created at once. finish() then removes
+#  the sources of a move only when all of it has been copied; a failed move
+#  has its partial copy removed and its source left in place.
 #
-def shellcommand(*a):
-    cmd = ' '.join(a)    
-    if args.dryrun:
-        print(cmd)
-    else:
+COPY_CHUNK = 1 << 24
+COPY_FALLBACK = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+COPY_TMPSUFFIX = '.mergetree-tmp'
+
+def _copy_file_range(fi, fo):
+    n = os.copy_file_range(fi, fo, COPY_CHUNK)
+    while n:
+        progress.transfer(n)
+        n = os.copy_file_range(fi, fo, COPY_CHUNK)
+
+def _sendfile(fi, fo):
+    n = os.sendfile(fo, fi, None, COPY_CHUNK)
+    while n:
+        progress.transfer(n)
+        n = os.sendfile(fo, fi, None, COPY_CHUNK)
+
+def _readwrite(fi, fo):
+    buf = os.read(fi, COPY_CHUNK)
+    while buf:
+        while buf:
+            n = os.write(fo, buf)
+            progress.transfer(n)
+            buf = buf[n:]
+        buf = os.read(fi, COPY_CHUNK)
+
+COPY_METHODS = [m for m in (
+    _copy_file_range if hasattr(os, 'copy_file_range') else None,
+    _sendfile if hasattr(os, 'sendfile') else None,
+    _readwrite) if m]
+
+def copy_data(fi, fo):
+    for m in COPY_METHODS[:-1]:
         try:
-            cl = list(a)
-            cmd = cl.pop(0)
-            if cmd == 'mv':
-                os.rename(cl[0], cl[1])
-            elif cmd == 'rm':
-                os.remove(cl[0])
-            elif cmd == 'rmdir':
-                os.rmdir(cl[0])
-            else:
-                internal_error('unknown shell command:', cmd)
+            m(fi, fo)
+            return
         except OSError as e:
-            print('Error in', cmd, ':', e, file=sys.stderr)
+            # only fall back when nothing is copied yet
+            if e.errno not in COPY_FALLBACK or os.lseek(fo, 0, os.SEEK_CUR) != 0:
+                raise
+    COPY_METHODS[-1](fi, fo)
+
+def copy_file(src, dst, s):
+    if stat.S_ISLNK(s.st_mode):
+        os.symlink(os.readlink(src), dst)
+        os.utime(dst, ns=(s.st_atime_ns, s.st_mtime_ns), follow_symlinks=False)
+        return
+    if not stat.S_ISREG(s.st_mode):
+        raise OSError(errno.EOPNOTSUPP, 'cannot copy special file across devices', src)
+    tmp = dst + COPY_TMPSUFFIX
+    fi = os.open(src, os.O_RDONLY)
+    try:
+        fo = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            copy_data(fi, fo)
+            os.fchmod(fo, stat.S_IMODE(s.st_mode))
+            os.utime(fo, ns=(s.st_atime_ns, s.st_mtime_ns))
+        finally:
+            os.close(fo)
+        os.rename(tmp, dst)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    finally:
+        os.close(fi)
+
+# one move across devices, a file or a whole tree
+class CopyJob:
+    __slots__ = ('op', 'src', 'dst', 'made', 'files', 'dirs', 'pending', 'size', 'error')
+
+    def __init__(self, op, src, dst):
+        self.op = op
+        self.src = src
+        self.dst = dst
+        self.made = False   # dst created by the copy
+        self.files = []     # sources copied
+        self.dirs = []      # (src, dst, stat), deepest first
+        self.pending = []   # futures of file copies
+        self.size = 0
+        self.error = None
+
+class CopyEngine:
+    def __init__(self, jobs, inflight):
+        self.jobs = max(jobs, 1)
+        self.limit = inflight
+        self.inflight = 0
+        self.cond = threading.Condition()
+        self.executor = None
+        self.moves = []
+
+    def busy(self):
+        return len(self.moves) > 0
+
+    # op: the fsops operation the move is for, errors are reported to it
+    def move(self, src, dst, op=None):
+        job = CopyJob(op, src, dst)
+        self.moves.append(job)
+        try:
+            self._move(job, src, dst)
+        except OSError as e:
+            job.error = e   # settled by finish(), copies may be running
+
+    def _move(self, job, src, dst):
+        s = os.lstat(src)
+        if stat.S_ISDIR(s.st_mode):
+            os.mkdir(dst, 0o700)
+            job.made = True
+            for e in sorted(os.listdir(src)):
+                self._move(job, os.path.join(src, e), os.path.join(dst, e))
+            job.dirs.append((src, dst, s))
+        else:
+            self._submit(job, src, dst, s)
+
+    def _submit(self, job, src, dst, s):
+        size = s.st_size
+        with self.cond:
+            while self.inflight > 0 and self.inflight + size > self.limit:
+                self.cond.wait()
+            self.inflight += size
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        job.files.append(src)
+        job.size += size
+        job.pending.append(self.executor.submit(self._copy, src, dst, s))
+
+    def _copy(self, src, dst, s):
+        try:
+            copy_file(src, dst, s)
+        finally:
+            with self.cond:
+                self.inflight -= s.st_size
+                self.cond.notify_all()
+
+    def _failed(self, job, e):
+        summary.moved -= 1
+        summary.copyfailed += 1
+        if job.op:
+            executor.error(job.op, e)
+        else:
+            print('Error in copy', job.src, ':', e, file=sys.stderr)
+
+    # wait for all copies, then settle each move: sources removed and copied
+    # directories given their mode and mtime, or the partial copy removed
+    def finish(self):
+        for job in self.moves:
+            for f in job.pending:
+                try:
+                    f.result()
+                except OSError as e:
+                    job.error = job.error or e
+            if job.error:
+                if job.made:
+                    shutil.rmtree(job.dst, ignore_errors=True)
+                self._failed(job, job.error)
+                continue
+            try:
+                for src in job.files:
+                    os.unlink(src)
+                for src, dst, s in job.dirs:
+                    os.chmod(dst, stat.S_IMODE(s.st_mode))
+                    os.utime(dst, ns=(s.st_atime_ns, s.st_mtime_ns))
+                    os.rmdir(src)
+            except OSError as e:
+                # copy is complete, the rest of source stays to be seen
+                print('Error in copy', job.src, ':', e, file=sys.stderr)
+            summary.copied += len(job.files)
+            summary.copiedbytes += job.size
+        self.moves = []
+
+    def shutdown(self):
+        self.finish()
+        if self.executor:
+            self.executor.shutdown()
+
+copier = None
+
+#
+# Operation executor
+#  operations are queued and done in order by batches; renames across
+#  devices are handed to the copier
+#
+executor = None
+
+# wait for operations queued and copies pending
+def settle():
+    executor.flush()
+    if copier.busy():
+        copier.finish()
+
+#
+# Journal for resuming an interrupted run
+#  JSON lines:
+#   ['T', trees]     what the journal is of: [lower, upper] or [plan]
+#   ['D', subpath]   merge of directory completed
+#   ['B', src, dst]  backup rename about to be done (synced at once)
+#   ['b', src]       backup rename done
+#   ['A', n]         n more plan operations applied
+#   ['F']            run finished, journal starts over next time
+#  other records are fsynced in batches; losing them only costs re-listing
+#
+JOURNAL_SYNC = 256
+
+class Journal:
+    # trees: absolute paths it is of, a journal of other ones is refused
+    def __init__(self, path, trees):
+        self.trees = None
+        self.done = set()
+        self.backups = {}
+        self.applied = 0
+        good = self._load(path) if os.path.exists(path) else 0
+        if self.trees is not None and self.trees != trees:
+            raise ValueError('journal of other trees: ' + ' '.join(self.trees))
+        self.file = open(path, 'a')
+        self.file.truncate(good)
+        self.unsynced = 0
+        if self.trees is None:
+            self.trees = trees
+            self._write(['T', trees], sync=True)
+
+    # returns length of the sound part
+    def _load(self, path):
+        good = 0
+        with open(path, 'rb') as f:
+            for l in f:
+                try:
+                    if not l.endswith(b'\n'): break
+                    r = json.loads(l)
+                except ValueError:
+                    break   # torn tail of a crash
+                good += len(l)
+                if r[0] == 'T':
+                    self.trees = r[1]
+                elif r[0] == 'D':
+                    self.done.add(r[1])
+                elif r[0] == 'B':
+                    self.backups[r[1]] = r[2]
+                elif r[0] == 'b':
+                    self.backups.pop(r[1], None)
+                elif r[0] == 'A':
+                    self.applied += r[1]
+                elif r[0] == 'F':
+                    self.trees = None
+                    self.done.clear()
+                    self.backups.clear()
+                    self.applied = 0
+                    good = 0
+        return good
+
+    def _write(self, r, sync=False):
+        self.file.write(json.dumps(r, separators=(',', ':')))
+        self.file.write('\n')
+        self.unsynced += 1
+        if sync or self.unsynced >= JOURNAL_SYNC:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def dir_done(self, subpath):
+        self._write(['D', subpath])
+
+    def backup(self, src, dst):
+        self._write(['B', src, dst], sync=True)
+
+    def backup_done(self, src):
+        self._write(['b', src])
+
+    def apply_done(self, n):
+        self._write(['A', n], sync=True)
+
+    # carry on backup renames a crash left behind
+    def resume_backups(self):
+        for src, dst in self.backups.items():
+            if os.path.lexists(src) and not os.path.lexists(dst):
+                verbose('##>', src)
+                executor.add(fsops.Rename(src, dst))
+                summary.move()
+            elif os.path.lexists(src):
+                print('Unfinished backup of', src, ':', dst, 'exists', file=sys.stderr)
+            executor.flush()
+            self.backup_done(src)
+        self.backups.clear()
+
+    def close(self, finished=True):
+        if finished:
+            self._write(['F'])
+        self.sync()
+        self.file.close()
+
+journal = None
+
+#
+# Operation plan
+#  fsops plan file: a header, then [op, fingerprint, path...] for each
+#  operation; fp is None when the path is to be created, and may be a
+#  function to get it, called only when a plan is written
+#
+PLAN_VERSION = 1
+
+def plan_header(lower, upper):
+    return {'mergetree': PLAN_VERSION, 'lower': lower, 'upper': upper}
 
 #
 # file operator
 #
 def move(f, t, s=''):
-    f = str(f)
     t = str(t) + s
-    shellcommand('mv', f, t)
+    if s and journal:
+        journal.backup(str(f), t)
+        executor.add(fsops.Rename(str(f), t, fp=f.fingerprint))
+        executor.flush()
+        journal.backup_done(str(f))
+    else:
+        executor.add(fsops.Rename(str(f), t, fp=f.fingerprint))
     summary.move()
 
 def remove(f):
-    f = str(f)
-    shellcommand('rm', f)
+    executor.add(fsops.Remove(str(f), fp=f.fingerprint))
     summary.remove()
 
 def removedir(d):
-    d = str(d)
-    shellcommand('rmdir', d)
+    settle()    # copies out of it may be pending
+    executor.add(fsops.Rmdir(str(d), fp=d.fingerprint))
     summary.removedir()
 
+def link(f, s, t):
+    executor.add(fsops.Link(f, t, fp=fingerprint(s)))
+    summary.link()
+
+def makedir(d, mode=0o777):
+    executor.add(fsops.Mkdir(d, mode=mode))
+    summary.makedir()
+
+# mode and mtime of a directory made, once its content is settled
+def copy_dirattr(d, s):
+    settle()    # copies into it may be pending
+    executor.add(fsops.SetAttr(d, stat.S_IMODE(s.st_mode), s.st_atime_ns, s.st_mtime_ns))
+
+#
+# Plan applier
+#  every operation is checked against its fingerprint just before doing it;
+#  mv never overwrites, since the planned removal of its target may be skipped
+#
+APPLY_SUMMARY = {
+    'mv': 'moved', 'rm': 'removed', 'rmdir': 'dirremoved',
+    'ln': 'linked', 'mkdir': 'dirmade',
+}
+
+# check done by the executor just before the operation
+def unchanged(op):
+    if op.name == 'setattr':   # of a directory the plan made
+        try:
+            return stat.S_ISDIR(os.lstat(op.path).st_mode)
+        except OSError:
+            return False
+    if op.fp is None:
+        return not os.path.lexists(op.path)
+    return fingerprint_matches(op.path, op.fp) and not (op.target and os.path.lexists(op.target))
+
+def apply_plan(f):
+    header, ops = fsops.read_plan(f)
+    if header.get('mergetree') != PLAN_VERSION:
+        raise ValueError('not a mergetree plan')
+    progress.start('Applying:' + header['upper'] + ':')
+    if journal and journal.applied:
+        for op in itertools.islice(ops, journal.applied):
+            pass
+        progress.increment(journal.applied)
+    while True:
+        b = list(itertools.islice(ops, args.batch))
+        if not b: break
+        for op in b:
+            progress.increment()
+            op.check = lambda op=op: unchanged(op)
+            if op.name == 'setattr':
+                settle()    # copies into the directory may be pending
+            executor.add(op)
+        if journal:
+            settle()
+            journal.apply_done(len(b))
+    settle()
+    for name, attr in APPLY_SUMMARY.items():
+        setattr(summary, attr, executor.stats.count[name] - executor.stats.errors[name])
+    progress.fin()
+
+#
+# Content index of lower tree for --dedupe
+#  regular files by size; digests are calculated only for sizes some upper
+#  file also has, and reused from the index file while ino/size/mtime match
+#
+DIGEST = hashlib.sha1
+DIGEST_BUFSIZE = 1 << 20
+
+def file_digest(path):
+    m = DIGEST()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(DIGEST_BUFSIZE), b''):
+            m.update(buf)
+    return m.hexdigest()
+
+class ContentIndex:
+    # entry: [subpath, readpath, stat, digest]
+    #  readpath differs from base+subpath for files not moved in yet (dryrun)
+    #  and may be the target of a move still queued (unsettled)
+
+    def __init__(self, base):
+        self.base = base
+        self.bysize = {}
+        self.known = {} # subpath -> [ino, size, mtime_ns, digest]
+        self.unsettled = set()
+
+    # readpath is to be read, its move must be done
+    def _settle(self, readpath):
+        if readpath in self.unsettled:
+            settle()
+            self.unsettled.clear()
+
+    def load(self, path):
+        with open(path) as f:
+            for l in f:
+                r = json.loads(l)
+                self.known[r[0]] = r[1:]
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            for c in self.bysize.values():
+                for subpath, readpath, s, d in c:
+                    if readpath != self.base + subpath:
+                        continue
+                    k = [s.st_ino, s.st_size, s.st_mtime_ns]
+                    if d is None:
+                        r = self.known.get(subpath)
+                        if not r or r[:3] != k: continue
+                        d = r[3]
+                    f.write(json.dumps([subpath] + k + [d], separators=(',', ':')))
+                    f.write('\n')
+
+    def add(self, subpath, s, readpath=None, digest=None, unsettled=False):
+        if s.st_size == 0: return   # nothing to save for empty files
+        readpath = readpath or self.base + subpath
+        if unsettled:
+            self.unsettled.add(readpath)
+        self.bysize.setdefault(s.st_size, []).append([subpath, readpath, s, digest])
+
+    def add_tree(self, tree):
+        for f in tree:
+            if f.is_dir():
+                if f.subtree is not None:
+                    self.add_tree(f.subtree)
+            elif f.is_reg():
+                self.add(f.subpath(), f.stat)
+
+    def _digest(self, e):
+        if e[3] is None:
+            subpath, readpath, s = e[:3]
+            r = self.known.get(subpath)
+            if r and r[:3] == [s.st_ino, s.st_size, s.st_mtime_ns]:
+                e[3] = r[3]
+            else:
+                self._settle(readpath)
+                e[3] = file_digest(readpath)
+        return e[3]
+
+    # returns (matching entry or None, digest of f or None)
+    def lookup(self, f):
+        c = self.bysize.get(f.size())
+        if not c: return None, None
+        d = file_digest(f.path())
+        for e in c:
+            if self._digest(e) == d:
+                if args.strict:
+                    self._settle(e[1])
+                    if not filecmp.cmp(e[1], f.path(), shallow=False):
+                        continue
+                return e, d
+        return None, d
+
+contents = None
+
 #
 # Comparator
 #
@@ -279,9 +929,15 @@ def compare(a, b):
     #verbose('***', a.subpath())
     if a.is_dir():
         if b.is_dir():
+            if a.subtree is None or b.subtree is None:
+                summary.merged_before(a)
+                return
             compare_tree(a.subtree, b.subtree)
             if args.remove:
                 removedir(b)
+            if journal:
+                settle()
+                journal.dir_done(a.subpath())
         else: # lower=directory, upper=file # move upper with renaming
             summary.lower_is_dir(a)
             move(b, a, args.backup)
@@ -323,8 +979,38 @@ def only_in_lower(f):
 
 def only_in_upper(f, lb):
     summary.only_in_upper(f)
+    if contents:
+        merge_dedupe(f, lb)
+        return
     # move upper file to lower directory
-    move(f.path(), f.path(lb))
+    move(f, f.path(lb))
+
+def merge_dedupe(f, lb):
+    t = f.path(lb)
+    if f.is_dir() and f.subtree is not None:
+        makedir(t, stat.S_IMODE(f.stat.st_mode) | stat.S_IRWXU)
+        for e in f.subtree:
+            merge_dedupe(e, lb)
+        copy_dirattr(t, f.stat)
+        removedir(f)
+        return
+    d = None
+    if f.is_reg():
+        try:
+            e, d = contents.lookup(f)
+        except OSError as x:
+            print('Error in digest', f, ':', x, file=sys.stderr)
+            e = None
+        if e:   # content is in lower tree already
+            summary.duplicate(f)
+            remove(f)
+            if args.dedupe == 'link':
+                link(lb + e[0], e[2], t)
+            return
+    move(f, t)
+    if f.is_reg():
+        moved = not args.dryrun and not args.plan
+        contents.add(f.subpath(), f.stat, t if moved else f.path(), d, unsettled=moved)
 
 def compare_tree(tree_a, tree_b):
     ia = 0
@@ -336,33 +1022,115 @@ def compare_tree(tree_a, tree_b):
             only_in_lower(a)
             ia += 1
         elif b.name < a.name:
+            progress.increment(b.weight())
             only_in_upper(b, tree_a.base)
             ib += 1
         else:
+            progress.increment()
             compare(a, b)
             ia += 1
             ib += 1
     for i in range(ia, len(tree_a)):
         only_in_lower(tree_a[i])
     for i in range(ib, len(tree_b)):
+        progress.increment(tree_b[i].weight())
         only_in_upper(tree_b[i], tree_a.base)
 
 #
-# Program main
+# Program main, importable: main(['-N', lower, upper])
 #
+def main(argv=None):
+    global args, log, progress, summary, copier, executor, journal, contents
+    args = argparser.parse_args(argv)
+    if args.apply:
+        if args.plan or args.lower or args.upper:
+            argparser.error('--apply takes no trees and no --plan')
+    elif not args.upper:
+        argparser.error('lower and upper trees are required')
+    if args.log:
+        args.verbose = True
 
-progress.start('Listing files:' + args.lower + ':')
-tree_lower = Tree(args.lower)
-progress.fin()
+    log = LogWriter(open(args.log, 'w') if args.log else sys.stdout) if args.verbose else None
+    progress = ProgressReporter(args.progress)
+    summary = Summary()
+    copier = CopyEngine(args.jobs, args.inflight << 20)
+    executor = fsops.Executor(dryrun=args.dryrun, batch=args.batch, echo=echo,
+                              on_exdev=lambda op: copier.move(op.path, op.target, op),
+                              on_skip=lambda op: summary.changed(op.path))
+    journal = None
+    contents = None
+    try:
+        merge()
+    finally:
+        progress.close()
+        if log:
+            log.close()
+
+def merge():
+    global journal, contents
+    if args.journal and not args.dryrun and not args.plan:
+        trees = [args.apply] if args.apply else [args.lower, args.upper]
+        try:
+            journal = Journal(args.journal, [os.path.abspath(t) for t in trees])
+        except (OSError, ValueError) as e:
+            print(args.journal, ':', e, file=sys.stderr)
+            sys.exit(1)
+        journal.resume_backups()
 
-progress.start('Listing files:' + args.upper + ':')
-tree_upper = Tree(args.upper)
-progress.fin()
+    if args.apply:
+        try:
+            with open(args.apply) as f:
+                apply_plan(f)
+        except (OSError, ValueError) as e:
+            print(args.apply, ':', e, file=sys.stderr)
+            sys.exit(1)
+        finally:
+            executor.close()
+            copier.shutdown()
+        if journal:
+            journal.close()
+        if args.summary:
+            summary.report()
+            executor.stats.report()
+        return
+
+    progress.start('Listing files:' + args.lower + ':')
+    # content index of --dedupe needs the whole lower tree
+    tree_lower = Tree(args.lower, prune_done=not args.dedupe)
+    progress.fin()
+
+    progress.start('Listing files:' + args.upper + ':')
+    tree_upper = Tree(args.upper)
+    progress.fin()
+
+    #tree_lower.dump(header='Lower Tree:')
+    #tree_upper.dump(header='Upper Tree:')
+
+    if args.dedupe:
+        contents = ContentIndex(args.lower)
+        if args.index and os.path.exists(args.index):
+            contents.load(args.index)
+        contents.add_tree(tree_lower)
+
+    if args.plan:
+        with open(args.plan, 'w') as f:
+            executor.plan = fsops.PlanWriter(f, plan_header(args.lower, args.upper))
+            compare_tree(tree_lower, tree_upper)
+    else:
+        progress.start('Merging:', tree_upper.total)
+        compare_tree(tree_lower, tree_upper)
+        executor.close()
+        copier.shutdown()
+        progress.fin()
+        if journal:
+            journal.close()
 
-#tree_lower.dump(header='Lower Tree:')
-#tree_upper.dump(header='Upper Tree:')
+    if contents and args.index:
+        contents.save(args.index)
 
-compare_tree(tree_lower, tree_upper)
+    if args.summary:
+        summary.report()
+        executor.stats.report()
 
-if args.summary:
-    summary.report()
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,44 @@
-#!/usr/bin/python3 -i
+#!/usr/bin/python3
 #
 # bc alternative, "pc" - Python Caluculator
 #
+# usage: pc [options] [file...]
+#
+# options:
+#  -p --precision   decimal arithmetic, scale digits after the point
+#  -F --fraction    exact rational arithmetic
+#  -a --array       functions take sequences too (NumPy if installed)
+#  -s --scale N
+#  -b --batch       evaluate lines from files or stdin, no prompt
+#  --serve SOCKET   evaluate lines sent to a unix socket
+#  --connect SOCKET evaluate files or stdin by a pc --serve
+#
 
+import sys
+import os
+import builtins
 from math import *
 
+#
+# Parse command line arguments
+#
+import argparse
+PROG = 'pc'
+DESCRIPTION = 'Python Calculator'
+argparser = argparse.ArgumentParser(prog=PROG, description=DESCRIPTION)
+mode = argparser.add_mutually_exclusive_group()
+mode.add_argument('-p', '--precision', help='arbitrary precision decimal arithmetic', action='store_true')
+mode.add_argument('-F', '--fraction', help='exact rational arithmetic', action='store_true')
+mode.add_argument('-a', '--array', help='functions accept sequences, evaluated in batch', action='store_true')
+argparser.add_argument('-s', '--scale', help='digits after the decimal point (default 20)', type=int, default=20)
+argparser.add_argument('-b', '--batch', help='evaluate each line of files or stdin, print results', action='store_true')
+argparser.add_argument('-u', '--unbuffered', help='flush after each result in batch mode', action='store_true')
+server = argparser.add_mutually_exclusive_group()
+server.add_argument('--serve', help='serve evaluation on unix socket', metavar='SOCKET')
+server.add_argument('--connect', help='evaluate by pc serving on unix socket', metavar='SOCKET')
+argparser.add_argument('file', nargs='*', help='expressions, one per line (- for stdin)')
+args = argparser.parse_args()
+
 # some aliases
 rad = radians
 deg = degrees
@@ -18,7 +52,430 @@ def pytha(x,y):
 def pythc(z,x):
     return sqrt(z**2 - x**2)
 
-# TBD: precision caler
+# digits after the point shown in precision mode, like bc
+scale = args.scale
+
+#
+# Precision mode
+#  numeric literals in arithmetic become Decimal (Fraction with -F) and
+#  results are shown with 'scale' digits after the point, like bc;
+#  'scale' may be set at the prompt. Functions work in Decimal.
+#  The context carries scale+GUARD digits; a result it rounds with
+#  digits before the point is done again with those digits added, so
+#  they are always exact, as in bc. decimal, fractions and ast are
+#  imported only for these modes
+#
+GUARD = 10  # extra digits carried in calculation
+
+def _exact(f):
+    def g(*a):
+        with localcontext() as c:
+            c.clear_flags()
+            r = f(*a)
+            if isinstance(r, Decimal) and c.flags[Rounded] and r.is_finite() and r.adjusted() >= 0:
+                c.prec += r.adjusted() + 1
+                r = f(*a)
+        return Number(r) if isinstance(r, Decimal) else r
+    return g
+
+def _dec(x):
+    if isinstance(x, Decimal): return x
+    if isinstance(x, Fraction): return Decimal(x.numerator) / x.denominator
+    if isinstance(x, float): return Decimal(repr(x))
+    return Decimal(x)
+
+def _pi():
+    with localcontext() as c:
+        c.prec += 2
+        three = Decimal(3)
+        lasts, t, s, n, na, d, da = 0, three, 3, 1, 0, 0, 24
+        while s != lasts:
+            lasts = s
+            n, na = n + na, na + 8
+            d, da = d + da, da + 32
+            t = (t * n) / d
+            s += t
+    return +s
+
+def _series(x, i, s):
+    # sin/cos Taylor series from the i-th term
+    with localcontext() as c:
+        c.prec += 2
+        lasts, fact, num, sign = 0, 1, s, 1
+        while s != lasts:
+            lasts = s
+            i += 2
+            fact *= i * (i - 1)
+            num *= x * x
+            sign = -sign
+            s += num / fact * sign
+    return +s
+
+def d_sin(x):
+    x = _dec(x) % (2 * _pi())
+    return _series(x, 1, x)
+
+def d_cos(x):
+    x = _dec(x) % (2 * _pi())
+    return _series(x, 0, Decimal(1))
+
+def d_tan(x):
+    return d_sin(x) / d_cos(x)
+
+def d_atan(x):
+    x = _dec(x)
+    with localcontext() as c:
+        c.prec += 4
+        if x.copy_abs() > 1:
+            r = _pi() / 2 - d_atan(1 / x.copy_abs())
+            if x < 0: r = -r
+        else:
+            for i in range(2):  # halve the angle twice, series converges fast
+                x = x / (1 + (1 + x * x).sqrt())
+            s, lasts, num, n = x, 0, x, 1
+            while s != lasts:
+                lasts = s
+                num *= -x * x
+                n += 2
+                s += num / n
+            r = 4 * s
+    return +r
+
+def d_atan2(y, x):
+    y, x = _dec(y), _dec(x)
+    if x > 0: return d_atan(y / x)
+    if x < 0: return d_atan(y / x) + (_pi() if y >= 0 else -_pi())
+    if y == 0: return Decimal(0)
+    return _pi() / 2 if y > 0 else -_pi() / 2
+
+def d_asin(x):
+    x = _dec(x)
+    if x.copy_abs() == 1: return x * _pi() / 2
+    return d_atan(x / (1 - x * x).sqrt())
+
+def d_acos(x):
+    return _pi() / 2 - d_asin(x)
+
+def d_log(x, base=None):
+    if base is None: return _dec(x).ln()
+    return _dec(x).ln() / _dec(base).ln()
+
+DECIMAL_FUNCTIONS = {name: _exact(f) for name, f in {
+    'sqrt': lambda x: _dec(x).sqrt(),
+    'exp': lambda x: _dec(x).exp(),
+    'log': d_log,
+    'log10': lambda x: _dec(x).log10(),
+    'pow': lambda x, y: _dec(x) ** _dec(y),
+    'sin': d_sin, 'cos': d_cos, 'tan': d_tan,
+    'asin': d_asin, 'acos': d_acos, 'atan': d_atan, 'atan2': d_atan2,
+    'rad': lambda d: _dec(d) * _pi() / 180, 'radians': lambda d: _dec(d) * _pi() / 180,
+    'deg': lambda r: _dec(r) * 180 / _pi(), 'degrees': lambda r: _dec(r) * 180 / _pi(),
+    'pytha': lambda x, y: (_dec(x) ** 2 + _dec(y) ** 2).sqrt(),
+    'pythc': lambda z, x: (_dec(z) ** 2 - _dec(x) ** 2).sqrt(),
+}.items()}
+
+# constants follow the precision
+def decimal_constants():
+    p = _pi()
+    return {'pi': p, 'qpi': p / 4, 'e': Decimal(1).exp()}
+
+if args.precision or args.fraction:
+    import ast
+    from decimal import Decimal, localcontext, getcontext, Rounded
+    from fractions import Fraction
+    F = Fraction
+
+    class Number(Decimal):
+        __slots__ = ()
+
+    for _name in ('add', 'sub', 'mul', 'truediv', 'floordiv', 'mod', 'pow'):
+        for _op in ('__%s__', '__r%s__'):
+            setattr(Number, _op % _name, _exact(getattr(Decimal, _op % _name)))
+    for _name in ('__neg__', '__pos__', '__abs__', 'sqrt', 'exp', 'ln', 'log10'):
+        setattr(Number, _name, _exact(getattr(Decimal, _name)))
+    del _name, _op
+    D = Number
+
+    class Literals(ast.NodeTransformer):
+        # floats everywhere, ints only as operands, so range(10) or x[1] still work
+        def __init__(self, name):
+            self.name = name
+
+        def _call(self, node):
+            return ast.copy_location(ast.Call(ast.Name(self.name, ast.Load()), [ast.Constant(repr(node.value))], []), node)
+
+        def _operand(self, node):
+            if isinstance(node, ast.Constant) and type(node.value) is int:
+                return self._call(node)
+            if isinstance(node, ast.UnaryOp) and isinstance(node.operand, ast.Constant) and type(node.operand.value) is int:
+                node.operand = self._call(node.operand)
+            return node
+
+        def visit_Constant(self, node):
+            if type(node.value) is float:
+                return self._call(node)
+            return node
+
+        def visit_BinOp(self, node):
+            self.generic_visit(node)
+            node.left = self._operand(node.left)
+            node.right = self._operand(node.right)
+            return node
+
+def format_value(v, scale):
+    if not (args.precision or args.fraction):
+        return repr(v)
+    if isinstance(v, Decimal) and v.is_finite():
+        with localcontext() as c:
+            c.prec = max(c.prec, v.adjusted() + scale + 2)
+            v = v.quantize(Decimal(1).scaleb(-scale)).normalize()
+        return format(v, 'f')
+    if isinstance(v, Fraction):
+        return str(v)
+    return repr(v)
+
+def show(v):
+    if v is None: return
+    builtins._ = v
+    print(format_value(v, scale))
+
+#
+# Array mode
+#  helpers evaluate whole sequences at once; NumPy ufuncs when NumPy is
+#  installed, otherwise an array('d') built in one pass per call
+#
+ARRAY_FUNCTIONS = ['sqrt', 'exp', 'log', 'log10', 'pow', 'sin', 'cos', 'tan',
+                   'asin', 'acos', 'atan', 'atan2', 'rad', 'radians', 'deg', 'degrees',
+                   'pytha', 'pythc']
+if args.array:
+    from array import array
+    SEQUENCES = (list, tuple, range, array)
+
+def vectorize(f):
+    def g(*a):
+        if not any(isinstance(x, SEQUENCES) for x in a):
+            return f(*a)
+        n = min(len(x) for x in a if isinstance(x, SEQUENCES))
+        cols = [x if isinstance(x, SEQUENCES) else [x] * n for x in a]
+        return array('d', map(f, *cols))
+    return g
+
+def array_functions():
+    try:
+        import numpy as np
+    except ImportError:
+        f = {name: vectorize(globals()[name]) for name in ARRAY_FUNCTIONS}
+        f['A'] = lambda s: array('d', s)
+        return f
+    # scalars and sequences as they are, iterators drained
+    def A(s):
+        return np.fromiter(s, dtype=float) if hasattr(s, '__next__') else np.asarray(s, dtype=float)
+    def log(x, base=None):
+        return np.log(x) if base is None else np.log(x) / np.log(base)
+    return {
+        'sqrt': np.sqrt, 'exp': np.exp, 'log': log, 'log10': np.log10, 'pow': np.power,
+        'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+        'asin': np.arcsin, 'acos': np.arccos, 'atan': np.arctan, 'atan2': np.arctan2,
+        'rad': np.radians, 'radians': np.radians, 'deg': np.degrees, 'degrees': np.degrees,
+        'pytha': np.hypot, 'pythc': lambda z, x: np.sqrt(np.square(A(z)) - np.square(A(x))),
+        'A': A, 'np': np,
+    }
+
+# read n-th column of numbers from a whitespace separated file
+def column(path, n=0, sep=None):
+    with open(path) as f:
+        conv = globals().get('A', list)
+        return conv(float(l.split(sep)[n]) for l in f if l.strip() and not l.lstrip().startswith('#'))
+
+#
+# Evaluator
+#  each distinct line is parsed, rewritten and compiled once; the decimal
+#  context follows 'scale' of the namespace before each evaluation
+#
+CODE_CACHE = 65536
+
+class Evaluator:
+    def __init__(self, ns, transform=None):
+        self.ns = ns
+        self.transform = transform
+        self.cache = {}
+        self.prec = None
+
+    def compile(self, source, filename='<pc>'):
+        c = self.cache.get(source)
+        if c is None:
+            if self.transform:
+                try:
+                    tree, mode = ast.parse(source, filename, 'eval'), 'eval'
+                except SyntaxError:
+                    tree, mode = ast.parse(source, filename, 'exec'), 'exec'
+                code = compile(ast.fix_missing_locations(self.transform.visit(tree)), filename, mode)
+            else:
+                try:
+                    code, mode = compile(source, filename, 'eval'), 'eval'
+                except SyntaxError:
+                    code, mode = compile(source, filename, 'exec'), 'exec'
+            if len(self.cache) >= CODE_CACHE:
+                self.cache.clear()
+            c = self.cache[source] = (code, mode == 'eval')
+        return c
+
+    # returns the value of an expression, None for a statement
+    def eval(self, source):
+        code, expr = self.compile(source)
+        self.sync()
+        if expr:
+            return eval(code, self.ns)
+        exec(code, self.ns)
+        return None
+
+    def format(self, v):
+        return format_value(v, self.scale)
+
+    def sync(self):
+        self.scale = int(self.ns.get('scale', args.scale))
+        if args.precision or args.fraction:
+            prec = self.scale + GUARD
+            if prec != self.prec or getcontext().prec != prec:
+                getcontext().prec = self.prec = prec
+                if args.precision:
+                    self.ns.update(decimal_constants())
+
+def lines(f):
+    for l in f:
+        l = l.strip()
+        if l and not l.startswith('#'):
+            yield l
+
+#
+# Batch mode
+#  one result line for each expression, statements print nothing
+#
+def batch(files):
+    ev = Evaluator(globals(), transform)
+    out = sys.stdout
+    status = 0
+    for path in files or ['-']:
+        try:
+            f = sys.stdin if path == '-' else open(path)
+        except OSError as e:
+            print('%s: %s' % (PROG, e), file=sys.stderr)
+            status = 1
+            continue
+        with f:
+            for l in lines(f):
+                try:
+                    v = ev.eval(l)
+                except Exception as e:
+                    print('%s: %s: %s' % (PROG, l, e), file=sys.stderr)
+                    status = 1
+                    continue
+                if v is not None:
+                    out.write(ev.format(v))
+                    out.write('\n')
+                    if args.unbuffered: out.flush()
+    return status
+
+#
+# Server mode
+#  a namespace of its own for each connection, answering one line for
+#  each line: the value, empty for a statement, or 'error: ...'.
+#  What it receives is executed, so the socket is for the owner only
+#  (mode 0600), and only a stale socket is replaced at the path
+#
+def serve(path):
+    import socketserver
+    import stat
+    base = dict(globals())
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            ev = Evaluator(dict(base), transform)
+            for l in self.rfile:
+                l = l.decode().strip()
+                try:
+                    v = ev.eval(l) if l and not l.startswith('#') else None
+                    r = '' if v is None else ev.format(v)
+                except Exception as e:
+                    r = 'error: %s' % e
+                self.wfile.write(r.encode() + b'\n')
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            print('%s: %s: exists and is not a socket' % (PROG, path), file=sys.stderr)
+            return 1
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    umask = os.umask(0o077)
+    try:
+        srv = Server(path, Handler)
+    finally:
+        os.umask(umask)
+    with srv:
+        try:
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+    return 0
+
+def connect(path, files):
+    import socket
+    import threading
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(path)
+
+    failed = []
+    def send():
+        try:
+            with s.makefile('wb') as w:
+                for p in files or ['-']:
+                    with (sys.stdin if p == '-' else open(p)) as f:
+                        for l in lines(f):
+                            w.write(l.encode() + b'\n')
+        except OSError as e:
+            print('%s: %s' % (PROG, e), file=sys.stderr)
+            failed.append(e)
+        finally:
+            try:
+                s.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    t = threading.Thread(target=send, daemon=True)
+    t.start()
+    status = 0
+    with s.makefile('rb') as r:
+        for l in r:
+            l = l.decode().rstrip('\n')
+            if l.startswith('error: '):
+                print('%s: %s' % (PROG, l[7:]), file=sys.stderr)
+                status = 1
+            elif l:
+                print(l)
+    t.join()
+    return 1 if failed else status
+
+transform = None
+if args.precision:
+    globals().update(DECIMAL_FUNCTIONS)
+    transform = Literals('D')
+elif args.fraction:
+    transform = Literals('F')
+elif args.array:
+    globals().update(array_functions())
+
+if args.serve:
+    sys.exit(serve(args.serve))
+if args.connect:
+    sys.exit(connect(args.connect, args.file))
+if args.batch or args.file or not sys.stdin.isatty():
+    sys.exit(batch(args.file))
 
 # Usage printer
 print('''\
@@ -30,18 +487,51 @@ Predefined:
  Trigonometric: sin(x), cos(x), tan(x), asin(x), acos(x), atan(x), atan2(y,x)
  Power, exponential, logarithmic: exp(x), log(x), pow(x,y), ...
 ''', end='')
+if args.precision or args.fraction:
+    print(' Precision: scale=%d digits after the point, D(x), F(x)' % scale)
+if args.array:
+    print(' Arrays: functions above take sequences, A(seq), column(file, n)')
+
+try:
+    import readline
+except ImportError:
+    pass
+
+#
+# Console
+#  literals are rewritten before compile, and the decimal context follows
+#  'scale' before each statement
+#
+import code
+
+class Console(code.InteractiveConsole):
+    def __init__(self, locals, transform=None):
+        super().__init__(locals)
+        self.transform = transform
+        self.evaluator = Evaluator(locals)
+
+    def runsource(self, source, filename='<input>', symbol='single'):
+        try:
+            c = self.compile(source, filename, symbol)
+        except (OverflowError, SyntaxError, ValueError):
+            self.showsyntaxerror(filename)
+            return False
+        if c is None:
+            return True
+        if self.transform:
+            tree = self.transform.visit(ast.parse(source, filename, symbol))
+            c = compile(ast.fix_missing_locations(tree), filename, symbol)
+        self.sync()
+        self.runcode(c)
+        return False
+
+    def sync(self):
+        global scale
+        self.evaluator.sync()
+        scale = self.evaluator.scale
 
-# print "bcl Original constants and functions::\n"
-# print "Constants:\n"
-# print " pi: Pi (3.141592...)\n"
-# print " qpi: 1/4 Pi\n"
-# print "Functions:\n"
-# print " rad(d): returns radian from degree\n"
-# print " deg(r): returns degree from radian\n"
-# print " pytha(x,y): returns sqrt(x^2 + y^2)\n"
-# print " pythc(z,x): returns sqrt(z^2 - x^2)\n"
-# print "Aliases:\n"
-# print " cos(r), sin(r), tan(r), atan(a), log(x)\n"
-# 
-# # standard precision for engineering
-# scale = 6
+console = Console(globals(), transform)
+console.sync()
+if args.precision or args.fraction:
+    sys.displayhook = show
+console.interact(banner='', exitmsg='')
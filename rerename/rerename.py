@@ -4,16 +4,29 @@
 #
 # usage:
 #  rerename [-options] regex subto files...
+#  rerename [-options] --undo undo-log
 #
 # options:
 #  -r  --recursive
 #  -N  --dryrun
+#  -j  --jobs N
+#  -x  --one-file-system
+#  -U  --undo-log FILE
+#  -S  --summary
 PROG = 'rerename'
 DESCRIPTION = 'rename files by reguler expression'
 
 import sys
 import os
 import re
+import stat
+import json
+import threading
+
+# shared modules, in ../common when run from the source tree
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'common'))
+import fswalk
+import fsops
 
 #
 # Parse command line arguments
@@ -22,37 +35,278 @@ import argparse
 argparser = argparse.ArgumentParser(prog=PROG, description=DESCRIPTION)
 argparser.add_argument('-r', '--recursive', help='scan recursively', action='store_true')
 argparser.add_argument('-N', '--dryrun', help='do nothing, just report what to do', action='store_true')
-argparser.add_argument('regex', help='reguler expression to match')
-argparser.add_argument('subto', help='substitute to')
-argparser.add_argument('path', nargs='+', help='path to rename')
+argparser.add_argument('-j', '--jobs', help='directories listed and renamed concurrently', type=int, default=8)
+argparser.add_argument('-x', '--one-file-system', help='do not descend to other filesystems', action='store_true')
+argparser.add_argument('-U', '--undo-log', help='record renames done to file')
+argparser.add_argument('-S', '--summary', help='report operation counts and timing', action='store_true')
+argparser.add_argument('--undo', help='roll back renames recorded by --undo-log', metavar='UNDO_LOG')
+argparser.add_argument('regex', nargs='?', help='reguler expression to match')
+argparser.add_argument('subto', nargs='?', help='substitute to')
+argparser.add_argument('path', nargs='*', help='path to rename')
+args = None
+
+regex = None
+subto = None
+
+errors = []
 
-args = argparser.parse_args()
+def error(*a):
+    errors.append(' '.join(a))
+
+# new name of a directory entry, None if unchanged
+def rename_of(name):
+    dst, n = regex.subn(subto, name)
+    if n == 0 or dst == name:
+        return None
+    if os.sep in dst or dst in ('', os.curdir, os.pardir):
+        error('cannot rename', name, 'to', repr(dst))
+        return None
+    return dst
 
 #
-# Application main
+# Rename plan of a directory
+#  made of the names scandir() gives, so no entry is stat'ed; targets are
+#  checked against the names in the directory, and chains (a->b, b->c) and
+#  cycles (a->b, b->a) are ordered or broken through a temporary name
 #
+TMPNAME = '.rerename-%d'
 
-### TBD: recursive
+class DirPlan:
+    __slots__ = ('path', 'depth', 'renames', 'walked')
 
-# obtain regex and compile
-regex = re.compile(args.regex)
-subto = args.subto
+    def __init__(self, path, depth):
+        self.path = path
+        self.depth = depth
+        self.renames = {}   # src -> dst
+        self.walked = False
 
-# process for one file
-def do_process(src):
-    if (not (os.path.isfile(src) or os.path.isdir(src))):
-        return None
+    def add(self, src, dst):
+        self.renames[src] = dst
+
+    def check(self, names):
+        names = set(names)
+        targets = {}
+        for src, dst in self.renames.items():
+            if dst in targets:
+                error(os.path.join(self.path, src), 'and', targets[dst], 'both rename to', dst)
+            else:
+                targets[dst] = os.path.join(self.path, src)
+            if dst in names and dst not in self.renames:
+                error(os.path.join(self.path, src), 'renames to existing', dst)
+
+    # exists(name) tells if a name is taken in the directory
+    def order(self, exists):
+        pending = dict(self.renames)
+        targets = set(pending.values())
+        for start in list(pending):
+            if start not in pending: continue
+            # follow the chain until a free name or back to start
+            chain = [start]
+            nxt = pending[start]
+            while nxt in pending and nxt != start:
+                chain.append(nxt)
+                nxt = pending[nxt]
+            if nxt == start:    # cycle, move start aside first
+                n = 0
+                while TMPNAME % n in pending or TMPNAME % n in targets or exists(TMPNAME % n):
+                    n += 1
+                tmp = TMPNAME % n
+                yield start, tmp
+                for src in reversed(chain[1:]):
+                    yield src, pending.pop(src)
+                yield tmp, pending.pop(start)
+            else:
+                for src in reversed(chain):
+                    yield src, pending.pop(src)
+
+plans = {}  # directory path -> DirPlan with renames
+
+def plan_for(path, depth):
+    plan = plans.get(path)
+    if plan is None:
+        plan = plans[path] = DirPlan(path, depth)
+    return plan
+
+def absdepth(path):
+    a = os.path.abspath(path)
+    return 0 if a == os.sep else a.count(os.sep)
+
+# plan renames for whole tree, one scandir() per directory
+def scan_tree(top, depth):
+    for d in fswalk.walkdirs(top, one_fs=args.one_file_system, jobs=args.jobs,
+                             onerror=lambda e: error(str(e))):
+        plan = plans.get(d.path) or DirPlan(d.path, depth + d.depth)
+        for e in d:
+            dst = rename_of(e.name)
+            if dst:
+                plan.add(e.name, dst)
+        plan.check([e.name for e in d])
+        plan.walked = True
+        if plan.renames:
+            plans[d.path] = plan
+
+# plan renames for paths given
+def plan_paths(paths):
+    for p in paths:
+        p = os.path.normpath(p)
+        parent, name = os.path.split(p)
+        parent = parent or os.curdir
+        try:
+            s = os.lstat(p)
+        except OSError as e:
+            error(str(e))
+            continue
+        depth = absdepth(parent)
+        if name not in (os.curdir, os.pardir):
+            dst = rename_of(name)
+            if dst:
+                plan_for(parent, depth).add(name, dst)
+        if args.recursive and stat.S_ISDIR(s.st_mode):
+            scan_tree(p, depth + 1)
+
+    for plan in plans.values():
+        if not plan.walked:
+            try:
+                plan.check(os.listdir(plan.path))
+            except OSError as e:
+                error(str(e))
+
+#
+# Undo log
+#  JSON lines [depth, directory, [src, dst, src, dst, ...]] of renames done,
+#  one line for each rename as it is done, with the absolute directory path;
+#  flushed and fsynced every UNDO_SYNC lines and at the end of a level.
+#  Rolled back shallowest directory first, each directory in reverse order
+#
+UNDO_SYNC = 256
+
+class UndoLog:
+    def __init__(self, path):
+        self.file = open(path, 'w')
+        self.cwd = os.getcwd()
+        self.depth = 0  # of the level being done
+        self.lock = threading.Lock()
+        self.unsynced = 0
+
+    # on_done of the executor, a rename done
+    def record(self, op):
+        d, src = os.path.split(op.path)
+        d = os.path.normpath(os.path.join(self.cwd, d))
+        l = json.dumps([self.depth, d, [src, os.path.basename(op.target)]], separators=(',', ':'))
+        with self.lock:
+            self.file.write(l + '\n')
+            self.unsynced += 1
+            if self.unsynced >= UNDO_SYNC:
+                self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def sync(self):
+        with self.lock:
+            self._sync()
 
-    #if (not regex.match(p)):
-    #    return None
+    def close(self):
+        self.sync()
+        self.file.close()
 
-    dst = regex.sub(subto, p)
-    if dst == src: return
-    if args.dryrun:
-        print('rename %s to %s'%(src,dst))
+def undo_order(done):
+    return lambda exists: [(done[i + 1], done[i]) for i in range(len(done) - 2, -1, -2)]
+
+def load_undo(path):
+    levels = {}
+    with open(path) as f:
+        for l in f:
+            depth, d, done = json.loads(l)
+            levels.setdefault(depth, []).append((depth, d, undo_order(done)))
+    # later renames of a directory are rolled back first
+    return [levels[k][::-1] for k in sorted(levels)]
+
+#
+# Execution
+#  renames are done by fsops.Executor, directories of the same depth
+#  concurrently, each in its own order and given up at its first error
+#  or skipped rename; depths go one after another so that directory paths
+#  stay valid
+#
+def report_skip(op):
+    print('Skipped %s: target exists' % op.command(), file=sys.stderr)
+
+# undo never overwrites, the name may be taken again since
+def target_free(op):
+    return not os.path.lexists(op.target)
+
+def execute(levels, undolog=None, undo=False):
+    executor = fsops.Executor(dryrun=args.dryrun, jobs=args.jobs, stop=True,
+                              on_done=undolog.record if undolog else None,
+                              on_skip=report_skip)
+    try:
+        for level in levels:
+            # before any add, since a full batch is done right away
+            if undolog:
+                undolog.depth = level[0][0]
+            for depth, d, order in level:
+                exists = lambda n: os.path.lexists(os.path.join(d, n))
+                for src, dst in order(exists):
+                    op = fsops.Rename(os.path.join(d, src), os.path.join(d, dst))
+                    if undo:
+                        op.check = lambda op=op: target_free(op)
+                    executor.add(op)
+            executor.flush()
+            if undolog:
+                undolog.sync()
+    except BaseException:
+        # renames running finish and get logged, the rest is not started
+        executor.cancel()
+        raise
+    executor.close()
+    if args.summary:
+        executor.stats.report()
+    return not executor.errors and not executor.stats.skipped
+
+#
+# Application main, importable: main(['-r', regex, subto, path])
+#
+def main(argv=None):
+    global args, regex, subto, errors, plans
+    args = argparser.parse_args(argv)
+    if args.undo:
+        if args.regex is not None:
+            argparser.error('--undo takes no regex nor path')
+    elif not args.path:
+        argparser.error('regex, subto and path are required')
+
+    # obtain regex and compile
+    regex = re.compile(args.regex or '')
+    subto = args.subto
+    errors = []
+    plans = {}
+
+    if args.undo:
+        levels = load_undo(args.undo)
     else:
-        os.rename(src, dst)    
+        plan_paths(args.path)
+        if errors:
+            for e in errors:
+                print(e, file=sys.stderr)
+            print('%s: nothing renamed' % PROG, file=sys.stderr)
+            sys.exit(1)
+        bydepth = {}
+        for plan in plans.values():
+            bydepth.setdefault(plan.depth, []).append((plan.depth, plan.path, plan.order))
+        # deepest first, so that directory paths stay valid
+        levels = [bydepth[k] for k in sorted(bydepth, reverse=True)]
+
+    undolog = UndoLog(args.undo_log) if args.undo_log and not args.dryrun else None
+    try:
+        ok = execute(levels, undolog, undo=bool(args.undo))
+    finally:
+        if undolog:
+            undolog.close()
+    if not ok:
+        sys.exit(1)
 
-# scan paths
-for p in args.path:
-    do_process(p)
+if __name__ == '__main__':
+    main()